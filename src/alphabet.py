@@ -1,8 +1,42 @@
 import os
+from collections import ChainMap, defaultdict
+import numpy as np
 from segment import Segment
 from natural_class import NaturalClass
 from utils import SYLLABLE_BOUNDARY, UNKNOWN_CHAR, NASALIZED
 
+class FeatureTable:
+    '''
+    The feature space and the segments' feature vectors (as tuples) read from an IPA file.
+    Tables are shared by all the Alphabets read from the same file (see read_feature_table), so they must not be modified.
+    '''
+    def __init__(self, feature_space, seg_to_feats):
+        self.feature_space = tuple(feature_space)
+        self.seg_to_feats = seg_to_feats
+
+_feature_tables = dict() # resolved path -> (modification time, FeatureTable)
+
+def read_feature_table(path):
+    '''
+    :path: the path to an IPA file, whose first line is the feature space and each other line a segment followed by its feature values (tab-separated)
+
+    :return: the file's FeatureTable, which is parsed once per process (and again only if the file is modified)
+    '''
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _feature_tables or _feature_tables[path][0] != mtime:
+        seg_to_feats = dict()
+        with open(path, 'r') as f:
+            for i, line in enumerate(f):
+                line = line.strip().split('\t')
+                seg, feats = line[0], line[1:]
+                if i == 0:
+                    feature_space = feats
+                else:
+                    seg_to_feats[seg] = tuple(feats)
+        _feature_tables[path] = (mtime, FeatureTable(feature_space, seg_to_feats))
+    return _feature_tables[path][1]
+
 class Alphabet:
     def __init__(self,
                  ipa_file='../data/ipa.txt',
@@ -13,21 +47,23 @@ class Alphabet:
         self.nas_vowels = nas_vowels
         dir_path = os.path.dirname(os.path.realpath(__file__))
 
-        self.seg_to_feats = dict()
-        with open(f'{dir_path}/{ipa_file}', 'r') as f:
-            for i, line in enumerate(f):
-                line = line.strip().split('\t')
-                seg, feats = line[0], line[1:]
-                if i == 0:
-                    self.feature_space = feats
-                else:
-                    self.seg_to_feats[seg] = feats
-
-        self.seg_to_feats[UNKNOWN_CHAR] = ['?'] * len(self.feature_space)
+        table = read_feature_table(f'{dir_path}/{ipa_file}')
+        self.feature_space = table.feature_space
+        self.seg_to_feats = ChainMap({UNKNOWN_CHAR: ('?',) * len(self.feature_space)}, table.seg_to_feats) # segments added here never write to the shared table
+        self.feat_index = dict((feat, i) for i, feat in enumerate(self.feature_space))
 
         self.ipa_to_segment = dict()
         self.feats_to_segment = dict()
 
+        # interned representation: each segment gets an integer ID and a (plus, minus) pair of feature bit-vectors
+        self.seg_to_id = dict()
+        self.id_to_seg = list()
+        self.seg_masks = list()
+        self.masks_to_segment = dict()
+        self.seg_feat_vals = list() # segment ID -> the set of its feature values (e.g., {+cons, -ant, ?back, ...})
+        self.seg_spec_feat_vals = list() # segment ID -> the same set, without the unspecified (?) features
+        self.feat_val_bits = defaultdict(int) # feature value -> bitset over the IDs of the segments (other than boundaries) with that value
+
         if segs:
             self.add_segments(segs)
         if add_segs:
@@ -41,11 +77,9 @@ class Alphabet:
             return True
         if ipa_seg == SYLLABLE_BOUNDARY:
             return False
-        feature_vec = self.seg_to_feats[ipa_seg]
+        feature_vec = list(self.seg_to_feats[ipa_seg])
         seg = Segment(ipa_seg, feature_vec)
-        self.segments.add(seg)
-        self.feats_to_segment[seg._hashable] = seg
-        self.ipa_to_segment[f'{seg}'] = seg
+        self._intern(seg)
         if self.nas_vowels: # add nasal versions of vowel segments
             self.add_nas_vowel(ipa_seg)
         return True
@@ -67,13 +101,115 @@ class Alphabet:
 
         :seg: a segment to be nasalized, if it is a vowel and does not already have a nasalized version in the alphabet
         '''
-        if self.get_val(seg, 'cons') == '-' and self.get_val(seg, 'nas') != '+':
+        if self.get_val(seg, 'cons') == '-' and self.get_val(seg, 'nas') != '+' and f'{seg}{NASALIZED}' not in self.ipa_to_segment: # keep the interned segment
             feature_vec = list(self.seg_to_feats[seg])
             feature_vec[self.feature_space.index('nas')] = '+'
             nas_seg = Segment(f'{seg}{NASALIZED}', feature_vec)
-            self.segments.add(nas_seg)
-            self.feats_to_segment[nas_seg._hashable] = nas_seg
-            self.ipa_to_segment[f'{seg}{NASALIZED}'] = nas_seg
+            self._intern(nas_seg)
+
+    def _intern(self, seg):
+        '''
+        Adds :seg: to the alphabet, giving it an integer ID (reused if a segment with the same IPA was added before) and its feature bit-vectors.
+        '''
+        self.segments.add(seg)
+        self.feats_to_segment[seg._hashable] = seg
+        self.ipa_to_segment[f'{seg}'] = seg
+        plus, minus = self.vec_to_masks(seg.feature_vec)
+        feat_vals = frozenset(f'{val}{feat}' for val, feat in zip(seg.feature_vec, self.feature_space))
+        spec_feat_vals = frozenset(feat for feat in feat_vals if feat[0] != '?')
+        if seg.ipa in self.seg_to_id:
+            seg_id = self.seg_to_id[seg.ipa]
+            seg.seg_id = seg_id
+            for feat in self.seg_feat_vals[seg_id]: # the replaced segment's values
+                self.feat_val_bits[feat] &= ~(1 << seg_id)
+            self.id_to_seg[seg_id] = seg
+            self.seg_masks[seg_id] = (plus, minus)
+            self.seg_feat_vals[seg_id] = feat_vals
+            self.seg_spec_feat_vals[seg_id] = spec_feat_vals
+        else:
+            seg.seg_id = len(self.id_to_seg)
+            self.seg_to_id[seg.ipa] = seg.seg_id
+            self.id_to_seg.append(seg)
+            self.seg_masks.append((plus, minus))
+            self.seg_feat_vals.append(feat_vals)
+            self.seg_spec_feat_vals.append(spec_feat_vals)
+        if seg.ipa != '#' and seg.ipa != SYLLABLE_BOUNDARY: # boundaries are in no natural class
+            for feat in feat_vals:
+                self.feat_val_bits[feat] |= 1 << seg.seg_id
+        self.masks_to_segment[(plus, minus)] = seg
+
+    def vec_to_masks(self, feature_vec):
+        '''
+        :feature_vec: a list of feature values ('+', '-', or '?')
+
+        :return: the (plus, minus) bit-vectors of :feature_vec:, where bit i is set if the i-th feature is '+' (resp. '-')
+        '''
+        plus, minus = 0, 0
+        for i, val in enumerate(feature_vec):
+            if val == '+':
+                plus |= 1 << i
+            elif val == '-':
+                minus |= 1 << i
+        return plus, minus
+
+    def feat_bit(self, feat):
+        '''
+        :return: the bit of :feat: in the feature bit-vectors
+        '''
+        if feat not in self.feat_index:
+            raise ValueError(f'"{feat}" is not in the feature space.')
+        return 1 << self.feat_index[feat]
+
+    def feats_to_masks(self, feats):
+        '''
+        :feats: an iterable of features marked with their values (e.g., {+voi, -son})
+
+        :return: the (plus, minus, unspec) bit-vectors that a segment must match to have all :feats:, or None if some feature is not in the feature space
+        '''
+        plus, minus, unspec = 0, 0, 0
+        for feat in feats:
+            val, name = feat[:1], feat[1:]
+            if name not in self.feat_index:
+                return None
+            bit = 1 << self.feat_index[name]
+            if val == '+':
+                plus |= bit
+            elif val == '-':
+                minus |= bit
+            elif val == '?':
+                unspec |= bit
+            else:
+                return None
+        return plus, minus, unspec
+
+    def seg_id(self, seg):
+        '''
+        :seg: a segment (in any format supported by __getitem__)
+
+        :return: the integer ID of :seg:
+        '''
+        return self.seg_to_id[self[seg].ipa]
+
+    def seg_id_matrix(self, strs, k):
+        '''
+        :strs: strings of :k: characters each
+
+        :return: the (len(strs) x k) matrix of the integer IDs of the strings' characters as segments (-1 if a character is not a segment)
+        '''
+        if len(strs) == 0:
+            return np.zeros((0, k), dtype=np.int64)
+        codes = np.frombuffer(''.join(strs).encode('utf-32-le'), dtype=np.uint32).reshape(len(strs), k)
+        chars, inverse = np.unique(codes, return_inverse=True)
+        table = np.asarray(list(self.seg_to_id.get(chr(c), -1) for c in chars), dtype=np.int64)
+        return table[inverse].reshape(len(strs), k)
+
+    def masks(self, seg):
+        '''
+        :seg: a segment (in any format supported by __getitem__)
+
+        :return: the (plus, minus) feature bit-vectors of :seg:
+        '''
+        return self.seg_masks[self.seg_id(seg)]
 
     def add_nas_vowels(self):
         '''
@@ -89,20 +225,19 @@ class Alphabet:
 
         :return: the segment with the same features as :seg: plus/minus those in :feats:, if such a segment exists 
         '''
-        seg = self[seg]
+        plus, minus = self.masks(seg)
         if type(feats) is str:
             feats = (feats,)
-        if not add and not all(seg.feature_vec[self.feature_space.index(feat)] for feat in feats):
-            return None
-        new_feat_vec = list(seg.feature_vec)
+        bits = 0
         for feat in feats:
-            feat_index = self.feature_space.index(feat)
-            new_feat_vec[feat_index] = '+' if add else '-'
-        if new_feat_vec not in self:
-            return None
-        if new_feat_vec == list(seg.feature_vec): # if the vector is unchanged, return None
+            bits |= self.feat_bit(feat)
+        if add:
+            new_masks = (plus | bits, minus & ~bits)
+        else:
+            new_masks = (plus & ~bits, minus | bits)
+        if new_masks == (plus, minus): # if the vector is unchanged, return None
             return None
-        return self[new_feat_vec]
+        return self.masks_to_segment.get(new_masks)
 
     def without_feats(self, seg, feats):
         '''
@@ -132,14 +267,18 @@ class Alphabet:
         '''
         if len(feats) != len(vals):
             raise ValueError(f'Length of :feats: and :vals: must be equal, but are |feats| = {len(feats)} and |vals| = {len(vals)}')
-        seg = self[seg]
-        new_feat_vec = list(seg.feature_vec)
+        plus, minus = self.masks(seg)
         for feat, val in zip(feats, vals):
-            feat_idx = self.feature_space.index(feat)
-            new_feat_vec[feat_idx] = val
-        if new_feat_vec not in self:
-            return None
-        return self[new_feat_vec]
+            bit = self.feat_bit(feat)
+            if val == '+':
+                plus, minus = plus | bit, minus & ~bit
+            elif val == '-':
+                plus, minus = plus & ~bit, minus | bit
+            elif val == '?':
+                plus, minus = plus & ~bit, minus & ~bit
+            else:
+                return None
+        return self.masks_to_segment.get((plus, minus))
 
     def __getitem__(self, key):
         '''
@@ -154,8 +293,8 @@ class Alphabet:
         typ = type(key)
         if typ is str and ',' not in key and key in self.ipa_to_segment:
             return self.ipa_to_segment[key]
-        elif typ is Segment:
-            return self[f'{key}']
+        elif typ is Segment and key.ipa in self.ipa_to_segment:
+            return self.ipa_to_segment[key.ipa]
         elif typ is str and ',' in key and key in self.feats_to_segment:
             return self.feats_to_segment[key]
         elif typ is list:
@@ -195,6 +334,20 @@ class Alphabet:
     def __iter__(self):
         return self.segments.__iter__()
 
+    def feats_to_bits(self, feats):
+        '''
+        :feats: an iterable of features marked with their values (e.g., {+voi, -son})
+
+        :return: the bitset over segment IDs of the segments (other than boundaries) that have all :feats:
+        '''
+        bits = (1 << len(self.id_to_seg)) - 1
+        for feat in feats:
+            bits &= self.feat_val_bits.get(feat, 0)
+        for seg in ('#', SYLLABLE_BOUNDARY):
+            if seg in self.seg_to_id:
+                bits &= ~(1 << self.seg_to_id[seg])
+        return bits
+
     def extension(self, nat_class):
         '''
         :nat_class: a set of features or a NaturalClass object
@@ -203,7 +356,7 @@ class Alphabet:
         '''
         if type(nat_class) is set:
             nat_class = NaturalClass(nat_class, self)
-        return set(filter(lambda seg: seg in nat_class, self.segments))
+        return nat_class.extension()
 
     def extension_complement(self, nat_class):
         '''
@@ -213,7 +366,7 @@ class Alphabet:
         '''
         if type(nat_class) is set:
             nat_class = NaturalClass(nat_class, self)
-        return set(filter(lambda seg: seg not in nat_class, self.segments))
+        return self.segments.difference(nat_class.extension())
 
     def complement(self, segs):
         '''
@@ -230,10 +383,8 @@ class Alphabet:
 
         :return: a set of the features, marked with their values for :seg: (e.g., {+cons, -ant, ?back, ...})
         '''
-        seg = self[seg]
-        if exclude_unspec:
-            return set(filter(lambda feat: feat[0] != '?', set(f'{seg.feature_vec[i]}{feat}' for i, feat in enumerate(self.feature_space))))
-        return set(f'{seg.feature_vec[i]}{feat}' for i, feat in enumerate(self.feature_space))
+        seg_id = self.seg_id(seg)
+        return set(self.seg_spec_feat_vals[seg_id] if exclude_unspec else self.seg_feat_vals[seg_id])
 
     def plus(self, seg):
         '''
@@ -241,7 +392,8 @@ class Alphabet:
 
         :return: a set of features that this seg has '+' for
         '''
-        return set(filter(lambda feat: feat[0] == '+', self.feat_vals(seg)))
+        plus, _ = self.masks(seg)
+        return set(f'+{feat}' for i, feat in enumerate(self.feature_space) if plus >> i & 1)
 
     def shared_feats(self, segs, exclude_unsepc=True):
         '''
@@ -249,15 +401,15 @@ class Alphabet:
 
         :return: the features shared by the :segs:
         '''
-        return set.intersection(*list(self.feat_vals(seg, exclude_unspec=exclude_unsepc) for seg in segs))
+        table = self.seg_spec_feat_vals if exclude_unsepc else self.seg_feat_vals
+        feat_vals = list(table[self.seg_id(seg)] for seg in segs)
+        return set(feat_vals[0]).intersection(*feat_vals[1:])
 
     def feat_diff(self, seg1, seg2):
-        diff = set()
-        seg1, seg2 = self[seg1], self[seg2]
-        for i, feat in enumerate(self.feature_space):
-            if seg1.feature_vec[i] != seg2.feature_vec[i]:
-                diff.add(feat)
-        return diff
+        plus1, minus1 = self.masks(seg1)
+        plus2, minus2 = self.masks(seg2)
+        diff_bits = (plus1 ^ plus2) | (minus1 ^ minus2)
+        return set(feat for i, feat in enumerate(self.feature_space) if diff_bits >> i & 1)
 
     def get_val(self, seg, feat):
         '''
@@ -266,5 +418,10 @@ class Alphabet:
 
         :return: the value of :feat: for :seg:
         '''
-        seg = self[seg]
-        return seg.feature_vec[self.feature_space.index(feat)]
\ No newline at end of file
+        plus, minus = self.masks(seg)
+        bit = self.feat_bit(feat)
+        if plus & bit:
+            return '+'
+        if minus & bit:
+            return '-'
+        return '?'
\ No newline at end of file
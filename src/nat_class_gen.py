@@ -1,13 +1,17 @@
-from collections import defaultdict
+import numpy as np
 
 from sequence import Sequence
 from natural_class import NaturalClass
 from utils import tolerance_principle, epsilon
 
 class NatClassGen:
-    def __init__(self, alphabet, skip_gen_A):
+    def __init__(self, alphabet, skip_gen_A, vectorized=True):
+        '''
+        :vectorized: if True, scores all candidate features at once with NumPy (see build_new_seq_vectorized); otherwise scores them one at a time
+        '''
         self.alphabet = alphabet
         self.skip_gen_A = skip_gen_A
+        self.vectorized = vectorized
 
     def induce_nat_classes(self, r, ngrams):
         target_index = r.A_index()
@@ -39,17 +43,14 @@ class NatClassGen:
             # print(es)
             return r
         
-        # cache the segments that take each feature
-        feat_to_segs = defaultdict(set)
-        for seg in self.alphabet.segments:
-            for feat in self.alphabet.feat_vals(seg):#self.alphabet.plus_minus(seg):
-                feat_to_segs[feat].add(seg)
+        def num_segs(feat): # the number of segments that take the feature
+            return bin(self.alphabet.feat_val_bits.get(feat, 0)).count('1')
 
         new_r = r.copy() # copy the rule
         i = 0
         for seq_seg, r_seg in zip(seq, new_r.CAD()):
             if len(seq_seg) == 0: # make sure every seg has at least one feature
-                options = sorted(self.alphabet.shared_feats(r_seg), key=lambda feat: (len(feat_to_segs[feat]), feat))
+                options = sorted(self.alphabet.shared_feats(r_seg), key=lambda feat: (num_segs(feat), feat))
                 seq_seg.add_feat(options[0])
             new_r.update_at(i, seq_seg)
             i += 1
@@ -66,6 +67,8 @@ class NatClassGen:
 
         :return: the new nat class sequence, along with and True if the seq is productive and False otherwise.
         '''
+        if self.vectorized:
+            return self.build_new_seq_vectorized(seq, feat_space, ngrams)
         last_score = None
         while len(feat_space) > 0:
             feat, score = self.get_best_feat(seq, feat_space, ngrams)
@@ -83,6 +86,75 @@ class NatClassGen:
             ngrams = list(filter(lambda ngram_f: seq.matches(ngram_f[0]), ngrams))
         return seq, False
 
+    def build_new_seq_vectorized(self, seq, feat_space, ngrams):
+        '''
+        Same as build_new_seq, but the :ngrams: are encoded once (see encode) and every greedy step scores all the candidate features in one pass.
+        '''
+        feats = sorted(feat_space)
+        ids, freqs, labs = self.encode(seq, feats, ngrams)
+        # M[i, j] is True iff the i-th ngram has the j-th candidate feature at the candidate's position
+        table, feat_cols = self.feat_table(feats)
+        M = table[ids[:, [idx for _, idx in feats]], feat_cols]
+        alive = np.ones(len(ngrams), dtype=bool) # the ngrams that match seq
+        remaining = np.ones(len(feats), dtype=bool) # the features still in the feat_space
+        last_score = None
+        while remaining.any():
+            weights = np.where(alive, freqs, 0)
+            n = weights @ M
+            c = np.where(labs, weights, 0) @ M
+            if (n[remaining] == 0).any():
+                raise ZeroDivisionError('division by zero')
+            scores = np.where(remaining, c / np.where(n == 0, 1, n), -np.inf)
+            j = int(np.argmax(scores))
+            score = float(scores[j])
+            remaining[j] = False
+            if score == last_score:
+                continue
+            last_score = score
+            f, idx = feats[j]
+            seq[idx].add_feat(f)
+            assert(not (labs & alive & ~M[:, j]).any())
+            alive &= M[:, j]
+            if tolerance_principle(n[j].item(), c[j].item()):
+                return seq, True
+        return seq, False
+
+    def encode(self, seq, feats, ngrams):
+        '''
+        :seq: the nat class sequence
+        :feats: the candidate (feature, position) pairs
+        :ngrams: (ngram, freq, label) triples, all matching :seq:
+
+        :return: an (n_ngrams x k) matrix of the segment IDs of the ngrams (-1 at positions without candidates), and the frequency and label vectors
+        '''
+        positions = sorted(set(idx for _, idx in feats))
+        ids = np.full((len(ngrams), len(seq)), -1, dtype=np.int64)
+        strs = list(f'{ngram}' for ngram, _, _ in ngrams)
+        if all(len(s) == len(seq) for s in strs): # every segment is a single character, so look them all up at once
+            ids[:, positions] = self.alphabet.seg_id_matrix(strs, len(seq))[:, positions]
+        else:
+            for row, (ngram, _, _) in enumerate(ngrams):
+                for idx in positions:
+                    ids[row, idx] = self.alphabet.seg_id(ngram[idx])
+        freqs = np.asarray(list(f for _, f, _ in ngrams))
+        labs = np.asarray(list(bool(lab) for _, _, lab in ngrams), dtype=bool)
+        return ids, freqs, labs
+
+    def feat_table(self, feats):
+        '''
+        :feats: the candidate (feature, position) pairs
+
+        :return: a (segment ID x feature) boolean table of which segments have which features, and the table column of each candidate in :feats:
+        '''
+        cols = sorted(set(feat for feat, _ in feats))
+        col_idx = dict((feat, j) for j, feat in enumerate(cols))
+        table = np.zeros((len(self.alphabet.id_to_seg), len(cols)), dtype=bool)
+        for seg_id, feat_vals in enumerate(self.alphabet.seg_feat_vals):
+            for feat in feat_vals:
+                if feat in col_idx:
+                    table[seg_id, col_idx[feat]] = True
+        return table, np.asarray(list(col_idx[feat] for feat, _ in feats), dtype=np.int64)
+
     def get_best_feat(self, seq, feat_space, ngrams):
         '''
         :return: the best-scoring feature in the :feat_space:
@@ -17,8 +17,40 @@ class NaturalClass:
         return segs
 
     def _update(self):
-        self.name = '{' + ','.join(sorted(self.feats)) + '}'
-        self.extension_str = '{' + ','.join(sorted(f'{seg}' for seg in self.alphabet.extension(self))) + '}'
+        '''
+        Recomputes the feature masks from :self.feats: (no alphabet scan) and drops the cached name and extension.
+        '''
+        self.masks = self.alphabet.feats_to_masks(self.feats)
+        self._name = None
+        self._extension_bits = 0
+        self._extension_upto = 0
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = '{' + ','.join(sorted(self.feats)) + '}'
+        return self._name
+
+    @property
+    def extension_str(self):
+        return '{' + ','.join(sorted(f'{seg}' for seg in self.extension())) + '}'
+
+    def extension_bits(self):
+        '''
+        :return: a bitset over segment IDs of the alphabet's segments in the class (see Alphabet.feats_to_bits), cached until segments are added
+        '''
+        num_segs = len(self.alphabet.id_to_seg)
+        if self._extension_upto != num_segs:
+            self._extension_bits = self.alphabet.feats_to_bits(self.feats) if self.masks is not None else 0
+            self._extension_upto = num_segs
+        return self._extension_bits
+
+    def extension(self):
+        '''
+        :return: the set of segments in the class
+        '''
+        bits = self.extension_bits()
+        return set(seg for seg_id, seg in enumerate(self.alphabet.id_to_seg) if bits >> seg_id & 1)
 
     def add_feat(self, feat):
         self.feats.add(feat)
@@ -37,10 +69,19 @@ class NaturalClass:
     def __contains__(self, item):
         if item == '#' or item == SYLLABLE_BOUNDARY:
             return False
-        return self.alphabet.feat_vals(f'{item}').intersection(self.feats) == self.feats
+        return self._has_feats(*self.alphabet.masks(item if type(item) is str else f'{item}'))
+
+    def _has_feats(self, plus, minus):
+        '''
+        :return: True if a segment with the feature bit-vectors :plus: and :minus: has all the class's features
+        '''
+        if self.masks is None: # some feature is not in the alphabet's feature space
+            return False
+        plus_req, minus_req, unspec_req = self.masks
+        return plus & plus_req == plus_req and minus & minus_req == minus_req and not (plus | minus) & unspec_req
 
     def __len__(self):
         return len(self.feats)
 
     def copy(self):
-        return NaturalClass(self.feats, self.alphabet, self.params)
\ No newline at end of file
+        return NaturalClass(self.feats, self.alphabet, self.params)
@@ -1,7 +1,11 @@
-from collections import defaultdict
-from nltk import ngrams
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, tee
+import io
+import mmap
+import pickle
 from utils import EMPTY_STRING
-from utils import tolerance_principle, align_blanks, UNKNOWN_CHAR
+from utils import tolerance_principle, align_blanks, stream, UNKNOWN_CHAR
 
 from rule import Rule
 from alphabet import Alphabet
@@ -10,6 +14,111 @@ from rule_builder import RuleBuilder
 from nat_class_gen import NatClassGen
 from discrepancies import Discrepancies
 from plp_grammar import PLPgrammar
+from vocab import Vocab, NGrams
+from profiler import Profiler, profiled
+
+class SharedAlphabetPickler(pickle.Pickler):
+    '''
+    Pickles references to :alphabet: by ID rather than by value, so that they are unpickled (by SharedAlphabetUnpickler)
+    as references to the unpickling process's own copy of the alphabet.
+    '''
+    def __init__(self, file, alphabet):
+        super().__init__(file)
+        self.alphabet = alphabet
+
+    def persistent_id(self, obj):
+        return 'alphabet' if obj is self.alphabet else None
+
+class SharedAlphabetUnpickler(pickle.Unpickler):
+    def __init__(self, file, alphabet):
+        super().__init__(file)
+        self.alphabet = alphabet
+
+    def persistent_load(self, pid):
+        return self.alphabet
+
+def dumps_shared(obj, alphabet):
+    f = io.BytesIO()
+    SharedAlphabetPickler(f, alphabet).dump(obj)
+    return f.getvalue()
+
+def loads_shared(data, alphabet):
+    return SharedAlphabetUnpickler(io.BytesIO(data), alphabet).load()
+
+_worker_alphabet = None # the alphabet of a rule-building worker process
+
+def _init_build_worker(alphabet):
+    global _worker_alphabet
+    _worker_alphabet = alphabet
+
+def _build_worker(task):
+    '''
+    :task: a (RuleBuilder, b) pair, pickled with dumps_shared
+
+    :return: the built rule, pickled with dumps_shared
+    '''
+    builder, b = loads_shared(task, _worker_alphabet)
+    return dumps_shared(builder.build(b=b), _worker_alphabet)
+
+_worker_grammar = None # the grammar of a producing worker process
+
+def _init_produce_worker(alphabet, grammar):
+    global _worker_alphabet, _worker_grammar
+    _worker_alphabet = alphabet
+    _worker_grammar = loads_shared(grammar, alphabet)
+
+def _produce_worker(task):
+    '''
+    :task: a (segments, URs) pair, pickled with dumps_shared: the IPA of the segments that the parent process's alphabet
+           had gained since the pool started, in the order it gained them, and a list of distinct URs
+
+    :return: the list of their SRs, pickled with dumps_shared
+    '''
+    segments, urs = loads_shared(task, _worker_alphabet)
+    _worker_alphabet.add_segments(segments) # catch up with the chunks produced by other workers
+    # as when producing serially, each UR is encoded just before it is produced, since the SRs depend on the segments in the alphabet
+    return dumps_shared(_worker_grammar.apply_batch(encode(ur, _worker_alphabet) for ur in urs), _worker_alphabet)
+
+def encode(ur, alphabet):
+    '''
+    Adds the segments of :ur: to :alphabet:.
+
+    :return: :ur: as a Sequence
+    '''
+    alphabet.add_segments_from_str(ur)
+    if type(ur) is str:
+        ur = Sequence(ur, alphabet=alphabet)
+    return ur
+
+def flatten(pairs, freqs=None, weighted=False):
+    '''
+    :pairs: (UR, SR) pairs or (UR, SR, freq) triples, or batches (lists) of them, e.g., from utils.stream
+    :freqs: (optional) the frequency of each pair
+    :weighted: if True, the frequencies are taken from the triples
+
+    :return: a generator over (uf, sf, freq) triples, where freq is None if not given by :freqs: or :weighted:
+    '''
+    freqs = iter(freqs) if freqs is not None else None
+    for item in pairs:
+        batch = item if type(item) is list and (len(item) == 0 or type(item[0]) is not str) else (item,)
+        for pair in batch:
+            if freqs is not None:
+                freq = next(freqs)
+            else:
+                freq = pair[2] if weighted and len(pair) > 2 else None
+            yield pair[0], pair[1], freq
+
+MODEL_FORMAT = 'plp-model'
+MODEL_VERSION = 1
+PRODUCE_STATE = ('threshold', 'verbose', 'alphabet', 'grammar', 'n_gram_lens', 'skip_gen_A', 'output_cache', 'profiler') # what a saved model needs to produce (see PLP.save)
+
+def read_urs(fname):
+    '''
+    Lazily reads the URs in :fname:, one per line (in the first tab-separated column, so a file of pairs can be read).
+    '''
+    with open(fname, 'r') as f:
+        for line in f:
+            yield line.strip().split('\t')[0]
 
 class PLP:
     def __init__(self,
@@ -19,18 +128,82 @@ class PLP:
                  add_segs=False,
                  n_grams_lens=[1, 2, 3], 
                  skip_gen_A=False,
+                 cache_size=65536,
+                 profile=False,
                  verbose=True):
         self.threshold = threshold
-        self.vocab = set()
+        self.vocab = Vocab()
         self.verbose = verbose
         self.alphabet = Alphabet(ipa_file=ipa_file, nas_vowels=nas_vowels, add_segs=add_segs)
         self.grammar = PLPgrammar()
         self.n_gram_lens = n_grams_lens
-        self.n_grams = dict((k, defaultdict(int)) for k in self.n_gram_lens)
+        self.n_grams = NGrams(self.n_gram_lens, self.alphabet)
+        self.ngram_rewrites = defaultdict(dict) # n-gram length -> {prefix of the grammar (as rule strings): (number of n-grams rewritten, {n-gram: rewrite})} (see rewrite_ngrams)
+        self.rewrites_num_segs = 0
         self.skip_gen_A = skip_gen_A
 
         self.rule_builders = {EMPTY_STRING: self.new_rule_builder(EMPTY_STRING)}
         self.discrepancies = Discrepancies()
+        self.counts = dict() # running (n, c) of each discrepancy's rule, for train_incremental
+        self.grammar_counts = None # running (n, c) of each grammar rule, for train_incremental
+        self.output_cache = PLP.OutputCache(cache_size)
+        self.profiler = Profiler(enabled=profile) # see Profiler.stats
+
+    class OutputCache:
+        '''
+        A bounded LRU cache of the SRs that produce returned, keyed by UR (as a string). It is cleared whenever the grammar is
+        updated (see update_rules) or the alphabet grows (which can change the output of a feature-changing rule), and its
+        entries are never pickled (e.g., by PLP.save).
+
+        :size: the maximum number of entries; 0 disables the cache
+        '''
+        def __init__(self, size):
+            self.size = size
+            self.entries = OrderedDict()
+            self.num_segs = 0
+            self.hits = 0
+            self.misses = 0
+
+        def get(self, ur, num_segs):
+            '''
+            :num_segs: the current size of the alphabet, which clears the cache if it changed
+
+            :return: the cached SR of :ur:, or None
+            '''
+            if num_segs != self.num_segs:
+                self.clear()
+                self.num_segs = num_segs
+            sf = self.entries.get(ur)
+            if sf is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(ur)
+            return sf
+
+        def put(self, ur, sf):
+            if self.size <= 0:
+                return
+            self.entries[ur] = sf
+            if len(self.entries) > self.size: # evict the least recently used entry
+                self.entries.popitem(last=False)
+
+        def clear(self):
+            self.entries.clear()
+
+        def stats(self):
+            '''
+            :return: a dict of the number of hits and misses and the current number of entries
+            '''
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+        def __getstate__(self):
+            state = dict(self.__dict__)
+            state['entries'] = OrderedDict()
+            return state
+
+        def __len__(self):
+            return len(self.entries)
 
     def new_rule_builder(self, target):
         '''
@@ -53,63 +226,164 @@ class PLP:
                 return Sequence(align_blanks(f'{uf}'.replace('\u0303', ''), f'{sf}'.replace('\u0303', ''))), sf
 
     def produce(self, uf):
-        self.alphabet.add_segments_from_str(uf)
-        if type(uf) is str:
-            uf = Sequence(uf, alphabet=self.alphabet)
-        return self.grammar.apply(uf)
+        '''
+        :return: the SR of :uf:; the SRs of URs given as strings are cached (see OutputCache), so must not be modified
+        '''
+        if type(uf) is not str:
+            return self.grammar.apply(encode(uf, self.alphabet))
+        sf = self.output_cache.get(uf, len(self.alphabet.id_to_seg))
+        if sf is None:
+            sf = self.grammar.apply(encode(uf, self.alphabet))
+            self.output_cache.put(uf, sf)
+        return sf
+
+    def produce_batch(self, urs, workers=None, chunksize=1000):
+        '''
+        Lazily maps each UR to its SR (as produce does, so through the output cache when serial), a chunk at a time:
+        each distinct UR in a chunk is encoded and produced once.
+
+        :urs: an iterable of URs, or the path to a file of URs (see read_urs)
+        :workers: if more than 1, the chunks are produced in a pool of this many processes
+        :chunksize: the number of URs per chunk
+        :return: a generator over the SRs, in the order of :urs:
+        '''
+        if type(urs) is str:
+            urs = read_urs(urs)
+        urs = iter(urs)
+        chunks = iter(lambda: list(islice(urs, chunksize)), list())
+        if workers is None or workers <= 1:
+            for chunk in chunks:
+                sfs = dict((ur, self.produce(ur)) for ur in dict.fromkeys(chunk))
+                yield from (sfs[ur] for ur in chunk)
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_produce_worker, initargs=(self.alphabet, dumps_shared(self.grammar, self.alphabet))) as pool:
+            pending = deque()
+            num_segs = len(self.alphabet.id_to_seg) # the workers start with the alphabet as it is now
+            def results(chunk, future):
+                sfs = dict(zip(dict.fromkeys(chunk), loads_shared(future.result(), self.alphabet)))
+                return (sfs[ur] for ur in chunk)
+            for chunk in chunks:
+                segments = list(f'{seg}' for seg in self.alphabet.id_to_seg[num_segs:])
+                for ur in chunk: # keep the alphabet the same as producing serially would
+                    self.alphabet.add_segments_from_str(ur)
+                pending.append((chunk, pool.submit(_produce_worker, dumps_shared((segments, list(dict.fromkeys(chunk))), self.alphabet))))
+                if len(pending) > 2 * workers: # bound the number of chunks in flight
+                    yield from results(*pending.popleft())
+            while pending:
+                yield from results(*pending.popleft())
 
     def __call__(self, uf):
         return self.produce(uf)
 
+    @profiled('induce_natural_classes')
     def induce_natural_classes(self):
         '''
         Induce natural classes over the rules.
         '''
         g = NatClassGen(self.alphabet, self.skip_gen_A)
+        if self.rewrites_num_segs != len(self.alphabet.id_to_seg): # new segments can change what a rule rewrites
+            self.ngram_rewrites = defaultdict(dict)
+            self.rewrites_num_segs = len(self.alphabet.id_to_seg)
         for r_idx in range(len(self.grammar)):
             r = self.grammar[r_idx]
             k = len(r)
             # compute the n-grams needed to compute the new rule's accuracy
+            rewrites = self.rewrite_ngrams(k, r_idx) # apply all the rules ranked above it in the grammar
             _ngrams = defaultdict(int)
             for ngram, f in self.n_grams[k].items():
-                # apply all the rules ranked above it in the grammar
-                for _r in self.grammar[:r_idx]:
-                    ngram = _r.apply(ngram)
+                ngram = rewrites[ngram] if ngram in rewrites else self.n_grams.sequence(ngram)
                 if len(ngram) == k:
                     _ngrams[ngram] += f
             new_r = g.induce_nat_classes(r, list(_ngrams.items()))
             self.grammar[r_idx] = new_r
+        # keep only the rewrites for prefixes of the new grammar
+        rules = list(r.stringify() for r in self.grammar)
+        prefixes = set(tuple(rules[:rank]) for rank in range(len(rules)))
+        for k, stages in self.ngram_rewrites.items():
+            self.ngram_rewrites[k] = dict((prefix, rewrites) for prefix, rewrites in stages.items() if prefix in prefixes)
 
-    def train(self, pairs):
+    def rewrite_ngrams(self, k, rank):
+        '''
+        Applies the grammar's first :rank: rules, in order, to each cached n-gram of length :k:.
+        The rewrites are cached per prefix of the grammar, so they are reused when the prefix has not changed (e.g., across
+        update_rules), and are otherwise computed from the longest cached prefix by applying only the remaining rules.
+
+        :return: a dict mapping each n-gram that the rules change to its rewrite (the others are left out)
+        '''
+        prefix = tuple(r.stringify() for r in self.grammar[:rank])
+        stages = self.ngram_rewrites[k]
+        start, (num_cached, cached) = 0, (0, dict())
+        for _prefix, stage in stages.items(): # find the longest cached prefix
+            if start <= len(_prefix) <= rank and prefix[:len(_prefix)] == _prefix:
+                start, (num_cached, cached) = len(_prefix), stage
+        num_ngrams = len(self.n_grams[k])
+        if start == rank and num_cached == num_ngrams:
+            return cached
+        rewrites = dict()
+        for i, ngram in enumerate(self.n_grams[k]): # n-grams are only ever added, so the first :num_cached: were rewritten
+            if i < num_cached: # only the rest of the prefix remains to be applied
+                rewrite, rules = cached[ngram] if ngram in cached else None, self.grammar[start:rank]
+            else:
+                rewrite, rules = None, self.grammar[:rank]
+            if rewrite is None and len(rules) == 0:
+                continue
+            if rewrite is None:
+                rewrite = self.n_grams.sequence(ngram)
+            for _r in rules:
+                rewrite = _r.apply(rewrite)
+            if len(rewrite) != len(ngram) or f'{rewrite}' != ngram:
+                rewrites[ngram] = rewrite
+        stages[prefix] = (num_ngrams, rewrites)
+        return rewrites
+
+    @profiled('train')
+    def train(self, pairs, freqs=None, workers=None, weighted=False):
+        '''
+        Train on (UR, SR) :pairs:.
+
+        :pairs: the pairs, which can also be (UR, SR, freq) triples or be given in batches (e.g., streamed with utils.stream; see flatten)
+        :freqs: (optional) the frequency of each pair (e.g., as returned by utils.load), to weight it by, as if it occurred that many times;
+        pairs whose frequency is None (e.g., from a corpus without a Freq column) are not weighted
+        :workers: if more than 1, the number of processes to build the discrepancies' rules in (see build_discrepancies)
+        :weighted: if True, weight the pairs by the frequencies in the (UR, SR, freq) triples
+        '''
         discrepancies = set()
-        for pair in pairs:
-            _, _, aligned_uf, aligned_sf = self.add_incremental(pair)
+        for uf, sf, freq in flatten(pairs, freqs, weighted):
+            _, _, aligned_uf, aligned_sf = self.add_incremental((uf, sf), freq=freq)
             if aligned_uf != aligned_sf:
                 for i in range(len(aligned_uf)):
                     if aligned_uf[i] != aligned_sf[i]: # discrepancy
                         discrepancies.add((aligned_uf[i], aligned_sf[i]))
 
-        for seg, b in sorted(discrepancies): # account for each discrepancy
-            r = self.rule_builders[seg].build(b=b)
-            self.discrepancies[(seg, b)] = r
+        self.build_discrepancies(sorted(discrepancies), workers=workers) # account for each discrepancy
 
         self.update_rules() # update the rules
         return self
 
-    def add_incremental(self, pair):
+    def add_incremental(self, pair, freq=None):
         '''
         Add a (UR, SR) pair.
 
+        :freq: (optional) the pair's frequency, which weights its n-grams and its part in the n and c of rules (see Vocab.add),
+        including those the rule builders compute. The two ways of counting a pair differ when it is added again: a pair
+        added with :freq: adds :freq: to its weight each time, as more tokens of it, whereas a pair added without one
+        keeps its weight of 1 in the n and c of rules, however many times it is added (its n-grams are still counted each time).
         :return: the orig pair (:uf: and :sf:) and the aligned pair (:aligned_uf:, :aligned_sf:)
         '''
         uf, sf = pair
+        if freq is not None and freq <= 0:
+            raise ValueError(f'The frequency of a pair must be positive, but that of {pair} is {freq}.')
+        weight = freq if freq is not None else 1
         self.alphabet.add_segments_from_str(uf) # add segments to alphabet
         self.alphabet.add_segments_from_str(sf)
-        for k in self.n_gram_lens: # cache n-grams
-            for ngram in ngrams(f'{uf}#', k):
-                self.n_grams[k][Sequence(list(ngram), self.alphabet)] += 1
+        self.n_grams.add(uf, weight) # cache n-grams
         uf, sf = Sequence(uf, self.alphabet), Sequence(sf, self.alphabet) # turn the strings into sequences
-        self.vocab.add((uf, sf)) # add the pair to the vocab
+        key = Vocab.key(uf, sf)
+        if key in self.vocab.pairs: # reuse the stored alignment
+            pair = self.vocab.add(uf, sf, freq=freq, key=key)
+        else: # add the pair (and its alignment) to the vocab
+            pair = self.vocab.add(uf, sf, *self.align(uf, sf), freq=freq, key=key)
+        aligned_uf, aligned_sf = pair.aligned_uf, pair.aligned_sf
 
         # make rule builders for each segment. 
         for i in range(len(uf)):
@@ -117,42 +391,39 @@ class PLP:
             if seg not in self.rule_builders:
                 self.rule_builders[seg] = self.new_rule_builder(seg)
 
-        aligned_uf, aligned_sf = self.align(uf, sf)
         idx = -1
         for i in range(len(aligned_uf)):
             seg = aligned_uf[i]
             if seg != EMPTY_STRING:
                 idx += 1
-                self.rule_builders[seg].add_instance(uf, i, b=aligned_sf[i], sf=sf)
+                self.rule_builders[seg].add_instance(uf, i, b=aligned_sf[i], sf=sf, pair=pair)
                 if i + 1 < len(aligned_uf) and aligned_uf[i + 1] == EMPTY_STRING:
                     pass
                 else:
-                    self.rule_builders[EMPTY_STRING].add_instance(uf, i, b=EMPTY_STRING, sf=sf, around_empty=True)
+                    self.rule_builders[EMPTY_STRING].add_instance(uf, i, b=EMPTY_STRING, sf=sf, around_empty=True, pair=pair)
             else:
-                self.rule_builders[EMPTY_STRING].add_instance(uf, idx, b=aligned_sf[i], sf=sf, around_empty=True)
+                self.rule_builders[EMPTY_STRING].add_instance(uf, idx, b=aligned_sf[i], sf=sf, around_empty=True, pair=pair)
         
         return uf, sf, aligned_uf, aligned_sf
 
-    def train_incremental(self, pair):
-        uf, sf, aligned_uf, aligned_sf = self.add_incremental(pair)
+    @profiled('train_incremental')
+    def train_incremental(self, pair, freq=None):
+        '''
+        Train on one more (UR, SR) :pair: (with optional frequency :freq:, see add_incremental).
+        '''
+        vocab_weight = self.vocab.weight
+        uf, sf, aligned_uf, aligned_sf = self.add_incremental(pair, freq=freq)
+        weight = self.vocab.weight - vocab_weight # how much the pair adds to the counts (0 for a repeated pair without a frequency)
         rules_changed = False
         '''
-        Find all overapplications
+        Find all overapplications that the rule can no longer tolerate
         '''
         for seg_b, rule in self.discrepancies.items():
-            if type(rule) is Rule:
-                n, c = rule.applies(uf, sf)
-            else:
-                n, c = 0, 0
-                for r in rule:
-                    _n, _c = r.applies(uf, sf)
-                    n += _n
-                    c += _c
-            if n != c: # overapplication
+            n, c = self.n_c(rule, [(uf, sf)]) # unweighted
+            N, C = self.discrepancy_counts(seg_b, n, c, weight)
+            if n != c and not self.threshold(n=N, c=C): # overapplication
                 seg, b = seg_b
-                r = self.rule_builders[seg].build(b=b)
-                self.discrepancies[(seg, b)] = r
-                rules_changed = True
+                rules_changed |= self.build_discrepancy(seg, b)
 
         '''
         Find all underapplications
@@ -162,35 +433,137 @@ class PLP:
                 if aligned_uf[i] != aligned_sf[i]: # discrepancy
                     seg, b = aligned_uf[i], aligned_sf[i]
                     rule = self.discrepancies[(seg, b)] if (seg, b) in self.discrepancies else None
-                    if not rule or (rule.apply(aligned_uf) == aligned_uf if type(rule) is Rule else all(r.apply(aligned_uf) == _uf for r in rule)): # underapplication
-                        r = self.rule_builders[seg].build(b=b)
-                        self.discrepancies[(seg, b)] = r
-                        rules_changed = True
+                    if not rule or (rule.apply(aligned_uf) == aligned_uf if type(rule) is Rule else all(r.apply(aligned_uf) == aligned_uf for r in rule)): # underapplication
+                        rules_changed |= self.build_discrepancy(seg, b)
 
         if rules_changed:
             self.update_rules()
-        elif UNKNOWN_CHAR in self.produce(uf): # if a natural class over-applied, make sure the rule is still tolerable
-            self.update_rules()        
+        elif self.grammar_crosses_threshold((uf, sf), weight) or UNKNOWN_CHAR in self.produce(uf): # if a natural class over-applied, make sure the rule is still tolerable
+            self.update_rules()
 
+    def n_c(self, rule, pairs):
+        '''
+        :rule: a Rule or a list of mutually exclusive Rules
+        :return: the rule's n and c summed over :pairs:
+        '''
+        if type(rule) is Rule:
+            return rule.get_n_c(pairs)
+        n, c = 0, 0
+        for r in rule:
+            _n, _c = r.get_n_c(pairs)
+            n += _n
+            c += _c
+        return n, c
+
+    def build_discrepancy(self, seg, b):
+        '''
+        (Re)builds the rule accounting for the :seg: --> :b: discrepancy and drops its running counts.
+
+        :return: True if the rule changed
+        '''
+        old = self.discrepancies.get((seg, b), None)
+        self.discrepancies[(seg, b)] = self.rule_builders[seg].build(b=b)
+        self.counts.pop((seg, b), None)
+        return f'{old}' != f'{self.discrepancies[(seg, b)]}'
+
+    @profiled('build_discrepancies')
+    def build_discrepancies(self, discrepancies, workers=None):
+        '''
+        Builds the rules accounting for each of the :discrepancies: ((seg, b) pairs), in order.
+
+        :workers: if more than 1, the builds are spread over a pool of this many processes. The rules are the same as
+        when built serially, but the threshold must be picklable (e.g., a module-level function rather than a lambda).
+        '''
+        if workers is None or workers <= 1:
+            for seg, b in discrepancies:
+                self.build_discrepancy(seg, b)
+            return
+        tasks = list(dumps_shared((self.rule_builders[seg], b), self.alphabet) for seg, b in discrepancies)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_build_worker, initargs=(self.alphabet,)) as pool:
+            for (seg, b), rule in zip(discrepancies, pool.map(_build_worker, tasks)): # map keeps the order of the tasks
+                self.discrepancies[(seg, b)] = loads_shared(rule, self.alphabet)
+                self.counts.pop((seg, b), None)
+
+    def discrepancy_counts(self, seg_b, n, c, weight):
+        '''
+        Updates the running (n, c) of the rule for the :seg_b: discrepancy with a pair's (unweighted) :n: and :c:, so that checking
+        the rule's tolerance costs O(|word|) rather than a pass over the vocab.
+        The counts are computed in full (over the builder's pairs, which the rule is built from) only after the rule is (re)built.
+
+        :weight: the weight the pair just added to the vocab
+        :return: the updated counts
+        '''
+        if seg_b not in self.counts: # includes the new pair
+            self.counts[seg_b] = self.n_c(self.discrepancies[seg_b], self.rule_builders[seg_b[0]].pairs)
+        elif weight:
+            N, C = self.counts[seg_b]
+            self.counts[seg_b] = (N + weight * n, C + weight * c)
+        return self.counts[seg_b]
+
+    def grammar_crosses_threshold(self, pair, weight):
+        '''
+        Updates the running (n, c) of each grammar rule (i.e., with its induced natural classes) with :pair:.
+        A rule may only be correct given the rules ordered before it, so only a rule going from tolerable to not tolerable counts.
+
+        :weight: the weight :pair: just added to the vocab
+        :return: True if some rule's counts crossed the threshold
+        '''
+        if self.grammar_counts is None: # includes the new pair
+            self.grammar_counts = [self.n_c(r, self.vocab) for r in self.grammar.rules]
+            return False
+        if not weight:
+            return False
+        crossed = False
+        for i, r in enumerate(self.grammar.rules):
+            n, c = self.n_c(r, [pair])
+            N, C = self.grammar_counts[i]
+            self.grammar_counts[i] = (N + weight * n, C + weight * c)
+            if n != c and self.threshold(n=N, c=C) and not self.threshold(n=N + weight * n, c=C + weight * c):
+                crossed = True
+        return crossed
+
+    @profiled('merge_rules')
     def merge_rules(self):
         '''
         Tries to combine rules that make the same change.
+
+        Only rules with the same B can merge, so each B's rules are merged separately. Merging is deterministic, so a pair of
+        rules that failed to merge is only retried once one of them has changed (by merging with another rule); rescans after
+        a merge thus only try the pairs involving changed rules. Each rule's (n, c) over the vocab is computed once.
         '''
-        change = True
-        while change: # while there is a change to some rule
-            change = False
-            num_rules = len(self.grammar)
-            pool = sorted(self.grammar.rules)
-            for i in range(num_rules):
-                for j in range(i + 1, num_rules):
-                    r1 = pool[i]
-                    r2 = pool[j]
-                    if r1 not in self.grammar or r2 not in self.grammar:
-                        continue
-                    if r1.merge(r2, self.vocab):
-                        self.grammar.remove(r2)
-                        change = True
+        counts = dict()
+        def n_c(rule):
+            key = rule.stringify()
+            if key not in counts:
+                counts[key] = rule.get_n_c(self.vocab)
+            return counts[key]
 
+        buckets = defaultdict(list)
+        for r in sorted(self.grammar.rules):
+            buckets[f'{r.B.seq}'].append(r)
+        failed = set() # pairs of rules (as strings) that do not merge
+        for bucket in buckets.values():
+            change = True
+            while change: # while there is a change to some rule
+                change = False
+                pool = sorted(bucket)
+                for i in range(len(pool)):
+                    for j in range(i + 1, len(pool)):
+                        r1 = pool[i]
+                        r2 = pool[j]
+                        if r1 not in self.grammar or r2 not in self.grammar:
+                            continue
+                        key = (r1.stringify(), r2.stringify())
+                        if key in failed:
+                            continue
+                        if r1.merge(r2, self.vocab, n_c=n_c):
+                            self.grammar.remove(r2)
+                            bucket.remove(r2)
+                            change = True
+                        else:
+                            failed.add(key)
+
+    @profiled('update_rules')
     def update_rules(self):
         '''
         Call after adding any rule.
@@ -198,30 +571,30 @@ class PLP:
         rules = self.discrepancies.get_rules() # get the rules accounting for all the discrepancies
         self.grammar.set_rules(list(r.copy().feature_changeify() for r in rules)) # set the grammar's rules
         self.merge_rules() # combine the rules
-        self.grammar.order_rules_by_scope(self.vocab) # assign some non-arbitrary initial ordering (by scope); actual ordering is after natural classes are induced
+        with self.profiler.stage('order_rules_by_scope'):
+            self.grammar.order_rules_by_scope(self.vocab) # assign some non-arbitrary initial ordering (by scope); actual ordering is after natural classes are induced
         self.induce_natural_classes() # induce nat classes
-        self.grammar.order_rules(self.vocab) # order the rules
+        with self.profiler.stage('order_rules'):
+            self.grammar.order_rules(self.vocab) # order the rules
+        self.grammar_counts = None # recomputed lazily by train_incremental
+        self.output_cache.clear()
 
-    def accuracy(self, test, return_errors=False):
+    @profiled('accuracy')
+    def accuracy(self, test, return_errors=False, workers=None, chunksize=1000):
         '''
         Compute accuracy of model on :test: (ur, sr) pairs.
+        The pairs are streamed through produce_batch, so a test file is never read into memory.
 
-        :test: the (ur, sr) pairs to test over.
+        :test: the (ur, sr) pairs to test over (possibly in batches, see flatten), or the path to a corpus file (read with utils.stream).
         :return_errors: if True, returns a list of printable errors.
+        :workers: see produce_batch
+        :chunksize: see produce_batch
         '''
         errors = list()
         t, c, = 0, 0
-        is_path = type(test) is str
-        if is_path:
-            iterable = open(test, 'r')
-        else:
-            iterable = test
-        for line in iterable:
-            if is_path:
-                uf, sf = line.strip().split('\t')
-            else:
-                uf, sf = line
-            pred = self.produce(uf)
+        pairs, _pairs = tee((uf, sf) for uf, sf, _ in flatten(stream(test) if type(test) is str else test))
+        preds = self.produce_batch((uf for uf, _ in _pairs), workers=workers, chunksize=chunksize)
+        for (uf, sf), pred in zip(pairs, preds):
             if sf == pred:
                 c += 1
             elif return_errors:
@@ -231,6 +604,41 @@ class PLP:
             return c / t if t > 0 else 0, errors
         return c / t if t > 0 else 0
 
+    def save(self, path, training_state=True):
+        '''
+        Saves the model to :path: in a binary format, which PLP.load restores without retraining or re-reading the IPA file.
+        The threshold must be picklable (e.g., a module-level function rather than a lambda).
+
+        :training_state: if True, the vocab, n-grams, discrepancies, and rule builders are saved too, so that training can
+        continue after loading; otherwise, only the alphabet and grammar are saved, and the loaded model can only produce
+        '''
+        if training_state:
+            state = self.__dict__
+        else:
+            state = dict((key, self.__dict__[key]) for key in PRODUCE_STATE)
+            state['grammar'] = PLPgrammar()
+            state['grammar'].rules = self.grammar.rules # without the application index, which is only needed to order rules
+        with open(path, 'wb') as f:
+            pickle.dump((MODEL_FORMAT, MODEL_VERSION, training_state, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        '''
+        Loads a model saved with PLP.save. The file is memory-mapped, so it is unpickled without first being copied into memory.
+
+        :return: the loaded PLP
+        '''
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            saved = pickle.loads(data)
+        if type(saved) is not tuple or len(saved) != 4 or saved[0] != MODEL_FORMAT:
+            raise ValueError(f'"{path}" is not a saved PLP model.')
+        _, version, training_state, state = saved
+        if version != MODEL_VERSION:
+            raise ValueError(f'"{path}" was saved in version {version} of the model format, but only version {MODEL_VERSION} is supported.')
+        plp = PLP.__new__(PLP)
+        plp.__dict__.update(state)
+        return plp
+
     def __str__(self):
         return self.grammar.__str__()
 
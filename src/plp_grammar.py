@@ -1,10 +1,180 @@
 import warnings
 warnings.filterwarnings("ignore")
 import networkx as nx
+from utils import UNKNOWN_CHAR, WORD_BOUNDARY
+from rule import Rule
+from sequence import Sequence
 
 class PLPgrammar:
     def __init__(self):
         self.rules = list()
+        self.application_index = PLPgrammar.ApplicationIndex()
+        self.applier = PLPgrammar.Applier()
+
+    class ApplicationIndex:
+        '''
+        Caches, for each rule (keyed by its string, as rules are compared), the rule's output on each pair in the vocab and
+        the set of pairs it applies to, as a bitset over the pairs' positions in the vocab. Ordering a pair of rules then only
+        needs to evaluate the pairs both rules apply to, and a rule's entry survives :update_rules: as long as the rule is unchanged.
+
+        Entries are extended over pairs added to the vocab since they were computed, and all are dropped if the vocab is
+        replaced or the alphabet grows (which can change the output of a feature-changing rule).
+        '''
+        def __init__(self):
+            self.vocab = None
+            self.pairs = list()
+            self.num_segs = 0
+            self.entries = dict() # rule string -> [outputs, bitset of the pairs the rule applies to]
+
+        def sync(self, vocab, rules):
+            '''
+            Brings the index up to date with :vocab: and drops the entries of rules not in :rules:.
+            '''
+            num_segs = max((len(r.alphabet.id_to_seg) for r in rules if r.alphabet is not None), default=0)
+            if vocab is not self.vocab or num_segs != self.num_segs or len(vocab) < len(self.pairs):
+                self.vocab = vocab
+                self.pairs = list()
+                self.num_segs = num_segs
+                self.entries = dict()
+            if len(vocab) != len(self.pairs):
+                self.pairs = list(vocab)
+            keys = set(r.stringify() for r in rules)
+            self.entries = dict((key, entry) for key, entry in self.entries.items() if key in keys)
+
+        def entry(self, rule):
+            '''
+            :return: the rule's outputs on the pairs and the bitset of the pairs that it applies to
+            '''
+            key = rule.stringify()
+            if key not in self.entries:
+                self.entries[key] = [list(), 0]
+            outputs, bits = self.entries[key]
+            for i in range(len(outputs), len(self.pairs)):
+                uf = self.pairs[i][0]
+                outputs.append(rule.apply(uf))
+                if outputs[i] != uf:
+                    bits |= 1 << i
+            self.entries[key][1] = bits
+            return outputs, bits
+
+        def more_specific(self, rule, other):
+            '''
+            The same as :rule.more_specific(other, vocab): (see Rule.more_specific).
+            '''
+            outputs, bits = self.entry(rule)
+            other_outputs, other_bits = self.entry(other)
+            both = bits & other_bits
+            if both == 0:
+                return False
+            c, other_c = 0, 0
+            while both:
+                i = (both & -both).bit_length() - 1
+                both &= both - 1
+                sf = self.pairs[i][1]
+                if UNKNOWN_CHAR not in other_outputs[i] and rule.apply(other_outputs[i]) == sf: # rule after other
+                    c += 1
+                if UNKNOWN_CHAR not in outputs[i] and other.apply(outputs[i]) == sf: # other after rule
+                    other_c += 1
+            return c < other_c
+
+    class Applier:
+        '''
+        Applies the rules in order, as apply would, but only where they can fire. Each rule is indexed by its anchor, the
+        position of its CAD that accepts the fewest segments: a rule can only match a window whose anchor accepts the segment
+        under it, so it is skipped unless its anchor accepts some segment of the word (as rewritten by the preceding rules),
+        and is otherwise only tried at the windows those segments anchor.
+
+        The index is rebuilt whenever the rules are replaced or recompiled (see Rule.compile).
+        '''
+        def __init__(self):
+            self.rules = list()
+            self.matchers = list()
+            self.anchors = list() # the anchor of each rule, or None if the rule can never fire
+            self.always = 0 # bitset of the rules without a CAD, which can fire on any word
+            self.index = dict() # segment (as IPA) -> bitset of the rules whose anchor accepts it
+
+        def sync(self, rules):
+            '''
+            Rebuilds the index if :rules: are not the ones (or not compiled as when) it was built for.
+            '''
+            if len(rules) == len(self.rules) and all(r is _r and r.compile() is m for r, _r, m in zip(rules, self.rules, self.matchers)):
+                return
+            self.rules = list(rules)
+            self.matchers = list(r.compile() for r in rules)
+            self.anchors = list()
+            self.always = 0
+            self.index = dict()
+            for r_idx, (rule, matcher) in enumerate(zip(self.rules, self.matchers)):
+                if matcher.never:
+                    self.anchors.append(None)
+                elif matcher.k == 0:
+                    self.anchors.append(None)
+                    self.always |= 1 << r_idx
+                else:
+                    segs = [WORD_BOUNDARY] if rule.alphabet is None else [WORD_BOUNDARY] + list(f'{seg}' for seg in rule.alphabet.id_to_seg)
+                    self.anchors.append(min(range(matcher.k), key=lambda j: sum(matcher.accepts(j, seg) for seg in segs)))
+
+        def rules_accepting(self, seg):
+            '''
+            :seg: a segment's IPA
+
+            :return: the bitset of the rules whose anchor accepts :seg:
+            '''
+            if seg not in self.index:
+                bits = 0
+                for r_idx, (matcher, j) in enumerate(zip(self.matchers, self.anchors)):
+                    if j is not None and matcher.accepts(j, seg):
+                        bits |= 1 << r_idx
+                self.index[seg] = bits
+            return self.index[seg]
+
+        def candidates(self, segs):
+            '''
+            :return: the bitset of the rules that may fire on :segs:
+            '''
+            index = self.index
+            bits = self.always | self.rules_accepting(WORD_BOUNDARY)
+            for seg in segs:
+                key = seg if type(seg) is str else seg.ipa
+                bits |= index[key] if key in index else self.rules_accepting(key)
+            return bits
+
+        def starts(self, r_idx, segs):
+            '''
+            :return: the starts of the windows of :segs: at which the anchor of rule :r_idx: accepts the segment, in ascending order
+            '''
+            j = self.anchors[r_idx]
+            if j is None:
+                return None
+            k = self.matchers[r_idx].k
+            starts = list()
+            for p in range(max(-1, 1 - k + j), min(len(segs), len(segs) - k + 1 + j) + 1): # the windows that apply tries
+                seg = segs[p] if 0 <= p < len(segs) else WORD_BOUNDARY
+                if self.rules_accepting(seg if type(seg) is str else seg.ipa) >> r_idx & 1:
+                    starts.append(p - j)
+            return starts
+
+        def apply(self, rules, uf):
+            '''
+            :return: the result of applying :rules: to :uf: in order
+            '''
+            sf = uf
+            segs = Rule._segments(sf) if type(sf) is Sequence else None
+            if segs is None:
+                for rule in rules:
+                    sf = rule.apply(sf)
+                return sf
+            self.sync(rules)
+            candidates = self.candidates(segs)
+            for r_idx, rule in enumerate(rules):
+                if segs is None: # a rule rewrote part of the word as a multi-segment string
+                    sf = rule.apply(sf)
+                elif candidates >> r_idx & 1:
+                    sf = rule.apply(sf, starts=self.starts(r_idx, segs))
+                    segs = Rule._segments(sf)
+                    if segs is not None:
+                        candidates = self.candidates(segs)
+            return sf
 
     def rules(self):
         return self.rules
@@ -19,22 +189,30 @@ class PLPgrammar:
         self.rules.remove(rule)
 
     def apply(self, uf):
-        sf = uf
-        for rule in self.rules:
-            sf = rule.apply(sf)
-        return sf
+        return self.applier.apply(self.rules, uf)
+
+    def apply_batch(self, ufs):
+        '''
+        Applies the grammar to each of :ufs:, syncing the applier (see Applier.sync) once for the whole batch.
+
+        :return: the list of SFs
+        '''
+        self.applier.sync(self.rules)
+        return list(self.applier.apply(self.rules, uf) for uf in ufs)
 
     def order_rules(self, vocab):
         if len(self) <= 1: # can't order one rule
             return
         nodes = list(self.rules)
+        index = self.application_index
+        index.sync(vocab, nodes)
         edges = list()
         for i in range(len(nodes)):
             for j in range(i + 1, len(nodes)):
                 ri, rj = nodes[i], nodes[j]
-                if ri.more_specific(rj, vocab):
+                if index.more_specific(ri, rj):
                     edges.append((ri, rj))
-                elif rj.more_specific(ri, vocab):
+                elif index.more_specific(rj, ri):
                     edges.append((rj, ri))
         G = nx.DiGraph()
         G.add_nodes_from(nodes)
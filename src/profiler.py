@@ -0,0 +1,84 @@
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from functools import wraps
+
+_no_stage = nullcontext()
+
+class Profiler:
+    '''
+    Accumulates the wall time and number of calls of each stage of a PLP (e.g., the stages of PLP.update_rules), and
+    counters of the work done within them, such as the number of Rule.apply calls, the pairs scanned by Rule.get_n_c and
+    the occurrences intersected by RuleBuilder.ContextIndex.n_c (which scores rules being built without scanning pairs).
+    Stages nest, and the time of a stage includes that of the stages within it.
+
+    When disabled, a stage is a no-op context manager and nothing is counted.
+    '''
+    active = None # the profiler of the innermost running stage, which rules count their work into (e.g., in Rule.apply)
+
+    def __init__(self, enabled=False, callback=None):
+        '''
+        :callback: (optional) called with the name and wall time (in seconds) of each stage when it ends
+        '''
+        self.enabled = enabled
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.stages = dict() # stage -> [number of calls, total wall time]
+        self.counters = defaultdict(int)
+
+    def stage(self, name):
+        '''
+        :return: a context manager that times the stage :name: and counts the work done within it into this profiler
+        '''
+        return Profiler.Stage(self, name) if self.enabled else _no_stage
+
+    class Stage:
+        def __init__(self, profiler, name):
+            self.profiler = profiler
+            self.name = name
+
+        def __enter__(self):
+            self.outer = Profiler.active
+            Profiler.active = self.profiler
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            seconds = time.perf_counter() - self.start
+            Profiler.active = self.outer
+            stats = self.profiler.stages.setdefault(self.name, [0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            if self.profiler.callback is not None:
+                self.profiler.callback(self.name, seconds)
+            return False
+
+    def stats(self):
+        '''
+        :return: a dict of the calls and wall time of each stage, and of the counters
+        '''
+        return {
+            'stages': dict((name, {'calls': calls, 'seconds': seconds}) for name, (calls, seconds) in self.stages.items()),
+            'counters': dict(self.counters),
+        }
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['callback'] = None # e.g., a lambda, which cannot be pickled
+        return state
+
+def profiled(name):
+    '''
+    :return: a decorator that runs a method of an object with a :profiler: (e.g., a PLP) as the stage :name: of that profiler
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.profiler.enabled:
+                return method(self, *args, **kwargs)
+            with Profiler.Stage(self.profiler, name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,6 +1,10 @@
-from utils import UNKNOWN_CHAR
-from utils import align_blanks, tolerance_principle
+from utils import UNKNOWN_CHAR, WORD_BOUNDARY
+from utils import tolerance_principle
+from segment import Segment
 from sequence import Sequence
+from natural_class import NaturalClass
+from vocab import AlignedPair, sf_alignments
+from profiler import Profiler
 
 class Rule:
     '''
@@ -8,6 +12,7 @@ class Rule:
     '''
     def __init__(self, A, B, C='*', D='*', alphabet=None):
         self.alphabet = alphabet
+        self._matcher = None
         if A is None and B is None and C is None and D is None:
             return
         self.A = Rule.RulePart(A, alphabet=alphabet)
@@ -37,18 +42,22 @@ class Rule:
         if type(seq) is list:
             seq = Sequence(seq, self.alphabet)
         self.C = Rule.RulePart(seq, self.alphabet)
+        self._matcher = None
 
     def update_A(self, seq):
         if type(seq) is list:
             seq = Sequence(seq, self.alphabet)
         self.A = Rule.RulePart(seq, self.alphabet)
+        self._matcher = None
 
     def update_D(self, seq):
         if type(seq) is list:
             seq = Sequence(seq, self.alphabet)
         self.D = Rule.RulePart(seq, self.alphabet)
+        self._matcher = None
 
     def to_natural_classes(self, segments=True):
+        self._matcher = None
         if not self.C.wildcard():
             self.C.seq.to_natural_classes(segments=segments)
         if not self.A.empty():
@@ -65,6 +74,7 @@ class Rule:
         return len_C
 
     def update_at(self, idx, seg):
+        self._matcher = None
         len_A = len(self.A)
         len_C = len(self.C)
         len_D = len(self.D)
@@ -171,6 +181,89 @@ class Rule:
         def __neq__(self, other):
             return not self.__eq__(other)
 
+    class Matcher:
+        '''
+        A compiled form of the rule's CAD: one test per window position, each with a table of the segments it accepts.
+        '''
+        def __init__(self, rule):
+            self.k = len(rule)
+            self.word_initial = len(rule.C) > 0 and (rule.C.seq[0] == '#' or rule.C.seq[0] == {'#'})
+            self.never = False # a '*' inside a (non-wildcard) part can never match a window
+            self.tests = list()
+            for part in (rule.C, rule.A, rule.D):
+                if part.wildcard():
+                    continue
+                if len(part) != len(part.seq):
+                    self.never = True
+                self.tests.extend(part.seq)
+            self.str_tables = list(dict() for _ in self.tests)
+            self.seg_tables = list(dict() for _ in self.tests)
+
+        def accepts(self, j, seg):
+            '''
+            :return: True if position :j: of the CAD accepts :seg:, caching the result
+            '''
+            table = self.str_tables[j] if type(seg) is str else self.seg_tables[j]
+            if seg in table:
+                return table[seg]
+            test = self.tests[j]
+            typ = type(test)
+            if test == '*':
+                res = True
+            elif typ is str or typ is Segment:
+                res = not (test != seg)
+            elif typ is set or typ is NaturalClass:
+                res = seg in test
+            else:
+                res = True
+            table[seg] = res
+            return res
+
+        def symbol(self, segs, idx):
+            '''
+            :return: the segment at :idx: of :segs:, where either end is a word boundary
+            '''
+            if 0 <= idx < len(segs):
+                return segs[idx]
+            return WORD_BOUNDARY
+
+        def match(self, segs, start, word_initial=False):
+            '''
+            :segs: the segments of a word (a str or a list of single segments)
+            :start: the index in :segs: at which the window starts
+            :word_initial: if True, index -1 is a word boundary that windows may start at
+
+            :return: True if the window of :segs: starting at :start: matches the CAD
+            '''
+            if self.never or start < (-1 if word_initial and self.word_initial else 0):
+                return False
+            for j in range(self.k):
+                if not self.accepts(j, self.symbol(segs, start + j)):
+                    return False
+            return True
+
+    def compile(self):
+        '''
+        :return: the rule's compiled matcher, which is built once and rebuilt only after the rule changes
+        '''
+        if self._matcher is None:
+            self._matcher = Rule.Matcher(self)
+        return self._matcher
+
+    @staticmethod
+    def _segments(s):
+        '''
+        :return: :s: as an indexable of single segments, or None if it holds other elements (e.g., multi-segment strings)
+        '''
+        if type(s) is str:
+            return s
+        if type(s) is not Sequence or type(s.seq) is not list:
+            return None
+        for seg in s.seq:
+            if not (type(seg) is Segment or (type(seg) is str and len(seg) == 1)):
+                return None
+        return s.seq
+
     def more_specific(self, other, pairs):
         '''
         :return: True if this rule needs to apply before the other
@@ -183,26 +276,32 @@ class Rule:
         return self.accuracy_after_other(other, pairs) < other.accuracy_after_other(self, pairs)
 
     def shift_excess_D_into_AB(self):
+        self._matcher = None
         excess_D = self.D.seq.seq[:-1]
         self.D.seq = Sequence(self.D.seq.seq[-1])
         self.A.seq = Sequence(self.A.seq.seq + excess_D)
         self.B.seq = Sequence(f'{self.B.seq}' + ''.join(excess_D))
 
-    def merge(self, other, pairs):
+    def merge(self, other, pairs, n_c=None):
         '''
         Merge two :other: rule with :self: rule, if possible.
 
+        :n_c: (optional) a function mapping a rule to its (n, c) over :pairs:, e.g., to cache them across merges
+
         :return: True if the rules are mergeable, False otherwise.
         '''
-        n, _ = self.get_n_c(pairs)
-        no, _ = other.get_n_c(pairs)
-        n_both = n + no
+        if n_c is None:
+            n_c = lambda rule: rule.get_n_c(pairs)
         # the rules must do the same thing to the target
         if self.B.seq != other.B.seq:
             return False
+        n, _ = n_c(self)
+        no, _ = n_c(other)
+        n_both = n + no
         # if the left and right contexts are identical, then we can just go ahead and merge straight away
         if self.A != other.A and len(self.A) == 1 and len(other.A) == 1 and self.C == other.C and self.D == other.D:
             self.A.seq.merge(other.A.seq)
+            self._matcher = None
             return True
         elif len(self.C) <= 1 and len(self.D) <= 1 and len(other.C) <= 1 and len(other.D) <= 1:
             nr = self.copy()
@@ -211,13 +310,14 @@ class Rule:
             nr.A.seq.merge(other.A.seq)
             if not nr.D.wildcard() and not other.D.wildcard():
                 nr.D.seq.merge(other.D.seq)
-            n, c = nr.get_n_c(pairs)
+            n, c = n_c(nr)
             if n >= n_both and tolerance_principle(n, c):
                 if not self.C.wildcard() and not other.C.wildcard():
                     self.C.seq.merge(other.C.seq)
                 self.A.seq.merge(other.A.seq)
                 if not self.D.wildcard() and not other.D.wildcard():
                     self.D.seq.merge(other.D.seq)
+                self._matcher = None
                 return True
         return False
 
@@ -268,9 +368,61 @@ class Rule:
     def __len__(self):
         return len(self.C) + len(self.A) + len(self.D)
 
-    def apply(self, s):
+    def apply(self, s, starts=None):
         '''
         Apply the rule to the string :s:
+
+        :starts: (optional) the window starts to try, in ascending order (see PLPgrammar.Applier); by default, every window is tried
+        '''
+        if Profiler.active is not None:
+            Profiler.active.counters['rule_apply'] += 1
+        segs = Rule._segments(s)
+        if segs is None:
+            return self._apply_windowed(s)
+        matcher = self.compile()
+        len_C = len(self.C) if not self.C.wildcard() else 0
+        A_start, A_end = len_C, len_C + len(self.A)
+        k = len(self)
+        out_tape = [''] * len(s)
+        if starts is None:
+            starts = range(1 - k, len(s) - k + 2) # the windows ending at each segment and at the word end
+        i = 0
+        for window_start_idx in starts:
+            while i < len(s) and i < window_start_idx + k: # pencil in identity up to the window's end
+                out_tape[i] = segs[i]
+                i += 1
+            if matcher.match(segs, window_start_idx, word_initial=True):
+                self._write(out_tape, segs, window_start_idx, len_C, A_start, A_end)
+        for i in range(i, len(s)):
+            out_tape[i] = segs[i]
+
+        out_seq = Sequence('', self.alphabet)
+        for seq in out_tape:
+            if seq != '':
+                out_seq += seq
+
+        return out_seq
+
+    def _write(self, out_tape, s, window_start_idx, len_C, A_start, A_end):
+        '''
+        Write the rule's change to the window starting at :window_start_idx: onto :out_tape:
+        '''
+        if self.A.empty(): # epenthesis
+            C_index = window_start_idx + len_C - 1
+            out_tape[C_index] = Sequence(f'{out_tape[C_index]}{self.B}', self.alphabet)
+        else:
+            if self.B.feature_change(): # change the feature
+                out_tape[window_start_idx + A_start] = self.B.apply(s[window_start_idx + A_start])
+            else:
+                for b_i, a_i in enumerate(range(A_start, A_end)): # for each character in A
+                    out_tape[window_start_idx + a_i] = Sequence(self.B.seq[b_i], self.alphabet) if len(self.B) > 0 else '' # overwrite with the next character in B
+                    rest = len(self.B) - b_i # compute what is left of B
+                    if a_i == A_end - 1 and b_i < len(self.B) - 1:
+                        out_tape[window_start_idx + a_i] += self.B.seq[b_i + 1:rest]
+
+    def _apply_windowed(self, s):
+        '''
+        Apply the rule to :s: with a sliding window, for inputs whose elements are not all single segments
         '''
         len_C = len(self.C) if not self.C.wildcard() else 0
         A_start, A_end = len_C, len_C + len(self.A)
@@ -288,19 +440,7 @@ class Rule:
             if len(window) > k:
                 window = window[1:]
             if self.equals_CAD(window):
-                window_start_idx = i - k + 1
-                if self.A.empty(): # epenthesis
-                    C_index = window_start_idx + len_C - 1
-                    out_tape[C_index] = Sequence(f'{out_tape[C_index]}{self.B}', self.alphabet)
-                else:
-                    if self.B.feature_change(): # change the feature
-                        out_tape[window_start_idx + A_start] = self.B.apply(s[window_start_idx + A_start])
-                    else:
-                        for b_i, a_i in enumerate(range(A_start, A_end)): # for each character in A
-                            out_tape[window_start_idx + a_i] = Sequence(self.B.seq[b_i], self.alphabet) if len(self.B) > 0 else '' # overwrite with the next character in B
-                            rest = len(self.B) - b_i # compute what is left of B
-                            if a_i == A_end - 1 and b_i < len(self.B) - 1:
-                                out_tape[window_start_idx + a_i] += self.B.seq[b_i + 1:rest]
+                self._write(out_tape, s, i - k + 1, len_C, A_start, A_end)
         
         out_seq = Sequence('', self.alphabet)
         for seq in out_tape:
@@ -316,13 +456,63 @@ class Rule:
         '''
         Comptes the number of times :self: applies to :uf: and how many of those are correct predictions w.r.t. :sf:
         '''
-        n, c = self.matches(uf, sf)
-        return len(n), len(c)
+        segs = Rule._segments(uf)
+        if segs is None:
+            n, c = self._matches_windowed(uf, sf)
+            return len(n), len(c)
+        n, c = 0, 0
+        for _, correct in self._hits(uf, sf, segs):
+            n += 1
+            if correct:
+                c += 1
+        return n, c
 
     def matches(self, uf, sf):
         '''
         Computes the matches of :self: on :uf: w.r.t. :sf:
         '''
+        segs = Rule._segments(uf)
+        if segs is None:
+            return self._matches_windowed(uf, sf)
+        n, c = list(), list()
+        k = len(self)
+        for window_start_idx, correct in self._hits(uf, sf, segs):
+            window = uf[window_start_idx:window_start_idx + k]
+            if window_start_idx + k > len(uf): # the window ends at the word end
+                window += '#'
+            n.append(window)
+            if correct:
+                c.append(window)
+        return n, c
+
+    def _hits(self, uf, sf, segs):
+        '''
+        :return: a generator of the start index of each window of :uf: that matches :self:, along with whether the match is a correct prediction w.r.t. :sf:
+        '''
+        matcher = self.compile()
+        k = len(self)
+        for i in range(len(uf) + 1): # +1 for word end
+            window_start_idx = i - k + 1
+            if matcher.match(segs, window_start_idx):
+                yield window_start_idx, self._correct(sf, window_start_idx, matcher.symbol(segs, window_start_idx + len(self.C)))
+
+    def _correct(self, sf, window_start_idx, target):
+        '''
+        :return: True if the rule's prediction for the window starting at :window_start_idx:, whose target is :target:, matches :sf:
+        '''
+        if self.A.empty(): # epenthesis
+            sf_B = sf[window_start_idx+len(self.C):window_start_idx+len(self.C)+len(self.B)]
+        else:
+            sf_B = sf[window_start_idx+len(self.C):window_start_idx+len(self.C)+len(self.A)]
+        if sf_B == 'λ':
+            sf_B = ''
+        pred_B = self.B.apply(target) if self.B.feature_change() else f'{self.B}'
+        return pred_B == sf_B
+
+    def _matches_windowed(self, uf, sf):
+        '''
+        Computes the matches of :self: on :uf: w.r.t. :sf: with a sliding window, for inputs whose elements are not all single segments
+        '''
         n, c = list(), list()
 
         window = '' if type(uf) is str else Sequence('', self.alphabet)
@@ -330,7 +520,6 @@ class Rule:
         for i in range(len(uf) + 1): # +1 for word end
             if i < len(uf):
                 window += uf[i]
-                window_C = window[0:len(self.C)]
             else:
                 window += '#'
             if len(window) > k: # update window
@@ -338,40 +527,39 @@ class Rule:
 
             if self.equals_CAD(window):
                 n.append(window)
-                window_start_idx = i - k + 1
-                if self.A.empty(): # epenthesis
-                    sf_B = sf[window_start_idx+len(self.C):window_start_idx+len(self.C)+len(self.B)]
-                else:
-                    sf_B = sf[window_start_idx+len(self.C):window_start_idx+len(self.C)+len(self.A)]
-                if sf_B == 'λ':
-                    sf_B = ''
-                pred_B = self.get_B(window)
-                if pred_B == sf_B:
+                if self._correct(sf, i - k + 1, window[len(self.C)] if self.B.feature_change() else None):
                     c.append(window)
         return n, c
 
     def get_n_c(self, pairs, num=True):
+        profiler = Profiler.active
+        num_pairs = 0
         n, c = (0, 0) if num else (list(), list())
-        for uf, sf in pairs:
+        for pair in pairs:
+            num_pairs += 1
+            uf, sf = pair
             if len(sf) < len(uf): # deletion
-                sf = align_blanks(f'{sf}', f'{uf}', return_ties=True)
-                if type(sf) is str:
-                    sf = Sequence(sf)
+                sfs = pair.sf_alignments() if type(pair) is AlignedPair else sf_alignments(uf, sf)
+                if len(sfs) == 1:
+                    sf = sfs[0]
                 else:
-                    sf = list(Sequence(_sf) for _sf in sf)
                     def _acc(__n, __c):
                         return __c / __n if __n > 0 else 0
-                    sf = sorted(sf, reverse=True, key=lambda _sf: _acc(*self.applies(uf, _sf)))[0]
+                    sf = sorted(sfs, reverse=True, key=lambda _sf: _acc(*self.applies(uf, _sf)))[0]
 
             if num:
                 _n, _c = self.applies(uf, sf)
-                n += _n
-                c += _c
+                w = pair.weight if type(pair) is AlignedPair else 1 # e.g., token frequency
+                n += w * _n
+                c += w * _c
             else:
                 _n, _c = self.matches(uf, sf)
                 n.extend(_n)
                 c.extend(_c)
 
+        if profiler is not None:
+            profiler.counters['get_n_c'] += 1
+            profiler.counters['get_n_c_pairs'] += num_pairs # counted as scanned, since :pairs: may be a generator
         return n, c
 
     def accuracy(self, pairs):
@@ -1,7 +1,12 @@
+from array import array
+from collections import defaultdict
+from functools import partial
 from segment import Segment
 from sequence import Sequence
 from rule import Rule
-from utils import EMPTY_STRING
+from vocab import AlignedPair, sf_alignments
+from utils import EMPTY_STRING, WORD_BOUNDARY
+from profiler import Profiler
 
 import numpy as np
 import networkx as nx
@@ -14,6 +19,7 @@ class RuleBuilder():
 
         self.instances = list()
         self.pairs = set()
+        self.context_index = RuleBuilder.ContextIndex(self)
 
     class Context:
         def __init__(self, lc, rc, b):
@@ -40,6 +46,176 @@ class RuleBuilder():
                     return False
             return True
 
+    class ContextIndex:
+        '''
+        An inverted index from positional context segments (offset, segment) to the occurrences of the target in the builder's pairs,
+        stored as bitsets over occurrence IDs. The n and c of a rule built from a window then come from intersecting these bitsets,
+        rather than from re-applying the rule to every pair.
+
+        An occurrence is a position at which the rule's A matches (for epenthesis, every gap in the UF), and offsets are relative to it.
+        Each occurrence counts with the weight of its pair (see AlignedPair), so the occurrences are also grouped by weight.
+
+        Adding a pair only appends its occurrence IDs to the lists of its keys; the bitsets of the keys that changed are
+        built from these lists when the index is next queried (see build), as most builders never need them.
+        '''
+        def __init__(self, builder):
+            self.builder = builder
+            self.len_A = 0 if builder.target == EMPTY_STRING else 1
+            self.occs = defaultdict(partial(array, 'I')) # (offset, segment) -> IDs of the occurrences with that segment at that offset
+            self.index = dict() # (offset, segment) -> bits of self.occs[(offset, segment)], as of the last build
+            self.num_occs = 0
+            self.num_built = 0 # the number of occurrences as of the last build
+            self.entries = list() # (uf, occurrence positions, first occurrence ID, alignments of the sf) for each pair
+            self.entry_of = dict() # pair -> index of its entry
+            self.weights = list() # the weight of each entry's pair
+            self.weight_masks = dict() # weight -> bits of the occurrences in pairs of that weight, or None if stale
+            self.correct = dict() # b -> (number of entries covered, bits of correct occurrences in single-alignment pairs, list of (pair bits, bits of correct occurrences under each alignment))
+            self.valid = True
+
+        @staticmethod
+        def bits(occs):
+            '''
+            :occs: a sequence of distinct occurrence IDs
+
+            :return: the bitset (an int) of :occs:
+            '''
+            if len(occs) == 0:
+                return 0
+            occs = np.asarray(occs, dtype=np.int64)
+            buf = np.zeros((int(occs.max()) >> 3) + 1, dtype=np.uint8)
+            np.bitwise_or.at(buf, occs >> 3, np.left_shift(1, occs & 7).astype(np.uint8))
+            return int.from_bytes(buf.tobytes(), 'little')
+
+        def add(self, pair):
+            '''
+            Indexes the occurrences of the target in :pair:.
+            '''
+            uf, sf = pair
+            if type(uf) is not Sequence or not all(type(seg) is Segment for seg in uf.seq):
+                self.valid = False # only index UFs of alphabet segments, where index lookups agree with rule matching
+                return
+            segs = uf.seq
+            if self.len_A == 0:
+                positions = list(range(len(segs) + 2))
+            else:
+                positions = list(i for i, seg in enumerate(segs) if not (self.builder.target != seg))
+            first = self.num_occs
+            occs = self.occs
+            context = list(segs) + [WORD_BOUNDARY] # the UF plus the word end (there is no word-initial boundary when scoring)
+            for occ, a in enumerate(positions, start=first):
+                for p in range(min(a, len(context))): # left context: offsets -1, -2, ...
+                    occs[(p - a, context[p])].append(occ)
+                for p in range(a + self.len_A, len(context)): # right context: offsets 1, 2, ...
+                    occs[(p - a - self.len_A + 1, context[p])].append(occ)
+            self.num_occs += len(positions)
+            if len(sf) < len(uf): # deletion
+                alignments = pair.sf_alignments() if type(pair) is AlignedPair else sf_alignments(uf, sf)
+            else:
+                alignments = (sf,)
+            weight = pair.weight if type(pair) is AlignedPair else 1
+            self.entry_of[pair] = len(self.entries)
+            self.entries.append((segs, positions, first, alignments))
+            self.weights.append(weight)
+            if positions:
+                self.weight_masks = None
+
+        def reweight(self, pair):
+            '''
+            Updates the index after the weight of :pair: (already added) changed.
+            '''
+            if not self.valid or type(pair) is not AlignedPair:
+                return
+            idx = self.entry_of[pair]
+            if self.weights[idx] == pair.weight:
+                return
+            self.weights[idx] = pair.weight
+            if self.entries[idx][1]:
+                self.weight_masks = None
+
+        def build(self):
+            '''
+            Brings the bitsets of the index up to date with the pairs added so far.
+            '''
+            if self.num_built < self.num_occs:
+                for key, occs in self.occs.items():
+                    if occs[-1] >= self.num_built: # the key has occurrences added since the last build
+                        self.index[key] = RuleBuilder.ContextIndex.bits(occs)
+                self.num_built = self.num_occs
+            if self.weight_masks is None:
+                occ_weights = np.repeat(np.asarray(self.weights, dtype=object), [len(positions) for _, positions, _, _ in self.entries])
+                self.weight_masks = dict((weight, RuleBuilder.ContextIndex.bits(np.flatnonzero(occ_weights == weight)))
+                                         for weight in dict.fromkeys(occ_weights))
+
+        def count(self, bits):
+            '''
+            :return: the total weight of the occurrences in :bits:
+            '''
+            if len(self.weight_masks) == 1: # e.g., all the pairs have weight 1
+                weight, = self.weight_masks
+                return weight * bin(bits).count('1')
+            return sum(weight * bin(bits & mask).count('1') for weight, mask in self.weight_masks.items())
+
+        def correct_bits(self, b):
+            '''
+            :return: the occurrences at which the context-free rule mapping the target to :b: makes a correct prediction (see n_c)
+            '''
+            covered, single, multi = self.correct.get(b, (0, 0, list()))
+            zero_rule = self.builder.build_rule_from_window(None, b)
+            single_occs = array('I')
+            for idx, (segs, positions, first, alignments) in enumerate(self.entries[covered:], start=covered):
+                alignment_occs = list()
+                for sf in alignments:
+                    occs = array('I')
+                    for occ, a in enumerate(positions, start=first):
+                        target = segs[a] if a < len(segs) else WORD_BOUNDARY
+                        if zero_rule._correct(sf, a, target):
+                            occs.append(occ)
+                    alignment_occs.append(occs)
+                if len(alignments) == 1:
+                    single_occs.extend(alignment_occs[0])
+                else:
+                    pair_bits = ((1 << len(positions)) - 1) << first
+                    multi.append((pair_bits, list(RuleBuilder.ContextIndex.bits(occs) for occs in alignment_occs), idx))
+            single |= RuleBuilder.ContextIndex.bits(single_occs)
+            self.correct[b] = (len(self.entries), single, multi)
+            return single, multi
+
+        def n_c(self, window, b):
+            '''
+            :return: the n and c (as Rule.get_n_c) of the rule that build_rule_from_window(:window:, :b:) builds
+            '''
+            self.build()
+            if Profiler.active is not None:
+                Profiler.active.counters['context_index_n_c'] += 1
+                Profiler.active.counters['context_index_occs'] += self.num_occs # the occurrences that the bitsets span
+            middle = window.index({'_'})
+            match = (1 << self.num_occs) - 1
+            for j, col in enumerate(window):
+                if j == middle:
+                    continue
+                offset = j - middle
+                bits = 0
+                for seg in col:
+                    bits |= self.index.get((offset, seg), 0)
+                match &= bits
+                if not match:
+                    break
+            single, multi = self.correct_bits(b)
+            n = self.count(match)
+            c = self.count(match & single)
+            for pair_bits, alignment_bits, idx in multi: # a deletion pair is scored under its best alignment
+                if match & pair_bits:
+                    c += self.weights[idx] * max(bin(match & bits).count('1') for bits in alignment_bits)
+            return n, c
+
+    def get_n_c(self, window, b):
+        '''
+        :return: the n and c of the rule built from :window: (see build_rule_from_window) over self.pairs
+        '''
+        if self.context_index.valid:
+            return self.context_index.n_c(window, b)
+        return self.build_rule_from_window(window, b).get_n_c(self.pairs)
+
     class Node:
         def __init__(self, pos, neg, condition):
             self.condition = condition
@@ -68,10 +244,19 @@ class RuleBuilder():
         rc += '#'
         return lc, rc
 
-    def add_instance(self, uf, i, b, sf, around_empty=False):
+    def add_instance(self, uf, i, b, sf, around_empty=False, pair=None):
+        '''
+        :pair: the (uf, sf) pair as stored in the vocab (e.g., an AlignedPair), if any; its weight (see AlignedPair)
+               weights it in the n and c of the rules built
+        '''
         lc, rc = self.get_left_and_right_context(uf, i, around_empty)
         self.instances.append(RuleBuilder.Context(lc=lc, rc=rc, b=b))
-        self.pairs.add((uf, sf))
+        pair = pair if pair is not None else (uf, sf)
+        if pair not in self.pairs:
+            self.pairs.add(pair)
+            self.context_index.add(pair)
+        else:
+            self.context_index.reweight(pair)
 
     def pad_to_len(self, s, target_len, pad_left):
         padded = list()
@@ -188,8 +373,7 @@ class RuleBuilder():
 
             window_scores = list()
             for window in pos_windows:
-                r = self.build_rule_from_window(window, b)
-                n, c = r.get_n_c(self.pairs)
+                n, c = self.get_n_c(window, b)
                 score = - c / n if n > 0 else 0 # since n is the same for all windows, the more correct predictions, the better the window
                 # tie-breakers
                 score -= 0.1 * window.count({'#'}) # prefer word boundaries
@@ -199,8 +383,7 @@ class RuleBuilder():
                 window_scores.append((window, score))
             best_window = sorted(window_scores, key=lambda it: it[-1])[0][0]
 
-            r = self.build_rule_from_window(best_window, b)
-            n, c = r.get_n_c(self.pairs)
+            n, c = self.get_n_c(best_window, b)
             if self.threshold(n=n, c=c):
                 return self.build_rule_from_window(best_window, b)
             elif k > 2 and (k - 1) % 2 == 0: # test for mutually exclusive contexts (e.g., intervocalic and post-nasl voicing)
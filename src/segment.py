@@ -1,18 +1,31 @@
 from natural_class import NaturalClass
 
 class Segment:
+    '''
+    A segment and its feature vector. An Alphabet interns its segments: it makes one Segment per IPA symbol and gives it an
+    integer ID (:seg_id:), so segments of the same alphabet are equal only if they are the same object. Segments from
+    different alphabets (or made without one) are equal if they have the same IPA and features.
+    '''
+    __slots__ = ('ipa', 'feature_vec', '_str', '_hashable', '_key', '_hash', 'seg_id')
+
     def __init__(self, ipa, feature_vec=[]):
         self.ipa = ipa
         self.feature_vec = feature_vec
         self._str = ipa
         self._hashable = ','.join(str(f) for f in self.feature_vec)
+        self._key = (ipa, self._hashable)
+        self._hash = hash(ipa) # the same as the IPA's, so that segments and strings can be looked up interchangeably
+        self.seg_id = None # set by the alphabet that interns the segment
 
     def __eq__(self, other):
-        if type(other) is Segment:
-            return hash((self.ipa, self._hashable)) == hash((other.ipa, other._hashable))
-        if type(other) is NaturalClass:
+        if other is self:
+            return True
+        typ = type(other)
+        if typ is Segment: # distinct segments of the same alphabet differ in IPA, so this only compares across alphabets
+            return self._key == other._key
+        if typ is NaturalClass:
             return False
-        if type(other) is str or type(other) is set:
+        if typ is str or typ is set:
             return self.ipa == other
         if len(other) == 1: # other should be a Sequence
             return self == other[0]
@@ -34,7 +47,15 @@ class Segment:
         return self.ipa.__le__(other if type(other) is str else other.ipa)
 
     def __hash__(self):
-        return hash(self.ipa)
+        return self._hash
+
+    def __getstate__(self):
+        return (self.ipa, self.feature_vec, self.seg_id)
+
+    def __setstate__(self, state):
+        ipa, feature_vec, seg_id = state
+        self.__init__(ipa, feature_vec) # string hashes differ between processes, so the hash must not be unpickled
+        self.seg_id = seg_id
 
     def __str__(self):
         return self._str
@@ -53,4 +74,14 @@ class Segment:
         return self.ipa.count(val)
 
     def __getitem__(self, idx):
-        return self.ipa[idx]
\ No newline at end of file
+        return self.ipa[idx]
+
+_boundaries = dict()
+
+def boundary(ipa):
+    '''
+    :return: the (featureless) Segment of the word or syllable boundary :ipa:, which is shared by all sequences
+    '''
+    if ipa not in _boundaries:
+        _boundaries[ipa] = Segment(ipa)
+    return _boundaries[ipa]
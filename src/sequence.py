@@ -1,5 +1,6 @@
+from array import array
 from natural_class import NaturalClass
-from segment import Segment
+from segment import Segment, boundary
 
 from utils import PRIMARY_STRESS, SECONDARY_STRESS, WORD_BOUNDARY, SYLLABLE_BOUNDARY, NASALIZED
 
@@ -26,7 +27,7 @@ class Sequence:
                     if temp[i] not in {PRIMARY_STRESS, SECONDARY_STRESS, WORD_BOUNDARY, SYLLABLE_BOUNDARY, '\u0303'}:
                         seq.append(alphabet[temp[i]])
                     elif temp[i] in {WORD_BOUNDARY, SYLLABLE_BOUNDARY}:
-                        seq.append(Segment(temp[i]))
+                        seq.append(boundary(temp[i]))
                     elif temp[i] == f'{NASALIZED}': # nasalized
                         seq[-1] = alphabet.with_feats(seq[-1], 'nas')
                     else:
@@ -84,7 +85,7 @@ class Sequence:
             return res
         if type(res) is NaturalClass and type(idx) is int:
             return res
-        return Sequence(res)
+        return Sequence(res, self.alphabet)
 
     def __setitem__(self, idx, val):
         self.seq[idx] = val
@@ -124,6 +125,12 @@ class Sequence:
             _windows.add((C, D))
         return sorted(_windows, key=lambda it: (it[0].__str__(), it[1].__str__()))
 
+    def freeze(self):
+        '''
+        :return: the sequence as a FrozenSequence, if it only holds segments of its alphabet and boundaries
+        '''
+        return FrozenSequence.from_segments(self.seq, self.alphabet)
+
     def __iadd__(self, other):
         if type(other) is str:
             self.seq += [other]
@@ -192,3 +199,119 @@ class Sequence:
                     self.seq[idx] = NaturalClass(self.alphabet.shared_feats({seg}), self.alphabet)
             elif type(seg) is set:
                 self.seq[idx] = NaturalClass(self.alphabet.shared_feats(seg), self.alphabet)
+
+BOUNDARY_IDS = {WORD_BOUNDARY: 0xFFFF, SYLLABLE_BOUNDARY: 0xFFFE} # reserved segment IDs of the boundaries in a FrozenSequence
+BOUNDARIES = dict((seg_id, seg) for seg, seg_id in BOUNDARY_IDS.items())
+
+class FrozenSequence:
+    '''
+    An immutable sequence of segments, stored compactly as an array of their IDs in :alphabet: (see Alphabet.seg_id).
+    Its string and hash are computed once, and slices are views that share the array rather than copy it.
+
+    It hashes and compares equal to its string (and to a Sequence of the same segments), so it can be used to look up
+    stores keyed by strings, such as NGrams. It also keys the pairs of a Vocab (see Vocab.key).
+    '''
+    __slots__ = ('ids', 'alphabet', 'start', 'stop', '_str', '_hash')
+
+    def __init__(self, ids, alphabet, start=0, stop=None):
+        '''
+        :ids: an array('H') of segment IDs, which must not be modified afterwards
+        :start: (optional) the start of the view of :ids:
+        :stop: (optional) the end of the view of :ids:
+        '''
+        self.ids = ids
+        self.alphabet = alphabet
+        self.start = start
+        self.stop = len(ids) if stop is None else stop
+        self._str = None
+        self._hash = None
+
+    @staticmethod
+    def from_segments(segs, alphabet):
+        '''
+        :segs: an iterable of the Segments of :alphabet: and boundaries
+
+        :return: the FrozenSequence of :segs:
+        '''
+        ids = array('H')
+        for seg in segs:
+            if type(seg) is Segment and seg.seg_id is not None and alphabet.id_to_seg[seg.seg_id] is seg: # interned by :alphabet:
+                ids.append(seg.seg_id)
+            elif (type(seg) is str or type(seg) is Segment) and seg in BOUNDARY_IDS:
+                ids.append(BOUNDARY_IDS[seg])
+            elif (type(seg) is str or type(seg) is Segment) and f'{seg}' in alphabet.seg_to_id and alphabet.id_to_seg[alphabet.seg_to_id[f'{seg}']] == seg:
+                ids.append(alphabet.seg_to_id[f'{seg}'])
+            else:
+                raise ValueError(f'"{seg}" is not a segment of the alphabet.')
+        return FrozenSequence(ids, alphabet)
+
+    @staticmethod
+    def from_str(s, alphabet):
+        return Sequence(s, alphabet).freeze()
+
+    def segment(self, seg_id):
+        return BOUNDARIES[seg_id] if seg_id in BOUNDARIES else self.alphabet.id_to_seg[seg_id]
+
+    def thaw(self):
+        '''
+        :return: a (mutable) Sequence of the same segments
+        '''
+        return Sequence(list(self), self.alphabet)
+
+    def view(self):
+        '''
+        :return: a memoryview of the segment IDs, without copying them
+        '''
+        return memoryview(self.ids)[self.start:self.stop]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, idx):
+        if type(idx) is slice:
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return FrozenSequence(self.ids, self.alphabet, self.start + start, self.start + max(start, stop))
+            return FrozenSequence(array('H', self.view()[idx]), self.alphabet)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('FrozenSequence index out of range')
+        return self.segment(self.ids[self.start + idx])
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield self.segment(self.ids[i])
+
+    def __str__(self):
+        if self._str is None:
+            self._str = ''.join(f'{seg}' for seg in self)
+        return self._str
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.__str__())
+        return self._hash
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        if type(other) is FrozenSequence and other.alphabet is self.alphabet:
+            return len(self) == len(other) and self.view() == other.view()
+        if type(other) is FrozenSequence or type(other) is str:
+            return self.__str__() == f'{other}'
+        if type(other) is Sequence:
+            return other == self.__str__()
+        return NotImplemented
+
+    def __lt__(self, other):
+        return self.__str__() < f'{other}'
+
+    def __getstate__(self):
+        return (self.ids, self.alphabet, self.start, self.stop)
+
+    def __setstate__(self, state):
+        self.__init__(*state) # the string and hash are recomputed, as string hashes differ between processes
@@ -8,6 +8,7 @@ EMPTY_STRING = 'λ'
 UNKNOWN_CHAR = '?'
 
 from collections import defaultdict
+from functools import lru_cache
 from itertools import chain, combinations
 import numpy as np
 from scipy.spatial.distance import hamming
@@ -19,16 +20,7 @@ def load(fname, sep='\t', skip_header=False, alphabet=False):
         if skip_header:
             next(f)
         for line in f:
-            line = line.strip().split(sep)
-            line_length = len(line)
-            if line_length == 2:
-                uf, sf = line
-                freq = 0
-            if line_length == 3:
-                uf, sf, freq = line
-            elif line_length == 4:
-                _, uf, sf, freq = line
-            freq = float(freq)
+            uf, sf, freq = parse_line(line, sep)
             pairs.append((uf, sf))
             freqs.append(freq)
     if alphabet:
@@ -47,6 +39,47 @@ def load(fname, sep='\t', skip_header=False, alphabet=False):
         return pairs, freqs, _alph
     return pairs, freqs
 
+def parse_line(line, sep='\t'):
+    '''
+    :line: a line of a corpus, with the columns UR and SR; UR, SR and Freq; or ID, UR, SR and Freq
+
+    :return: the line's (uf, sf, freq), where freq is None if there is no Freq column
+    '''
+    line = line.strip().split(sep)
+    line_length = len(line)
+    if line_length == 2:
+        uf, sf = line
+        return uf, sf, None
+    elif line_length == 3:
+        uf, sf, freq = line
+    elif line_length == 4:
+        _, uf, sf, freq = line
+    else:
+        raise ValueError(f'Expected 2, 3 or 4 columns, but got {line_length}: {line}')
+    return uf, sf, float(freq)
+
+def stream(fname, sep='\t', skip_header=False, chunksize=10000, buffering=-1):
+    '''
+    Lazily reads a corpus in any of the formats load reads, so that it is never held in memory at once.
+
+    :chunksize: the number of lines per batch
+    :buffering: the buffering policy of the file (see open)
+    :return: a generator over batches (lists) of (uf, sf, freq) triples (see parse_line)
+    '''
+    with open(fname, 'r', buffering=buffering) as f:
+        if skip_header:
+            next(f, None)
+        batch = list()
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(parse_line(line, sep))
+            if len(batch) == chunksize:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
 def tolerance_principle(n, c, e=None):
     if n == c:
         return True
@@ -147,10 +180,61 @@ def insert_empty(s, k=1):
         options.append(''.join(new))
     return options
 
+ALIGNMENT_CACHE_SIZE = 2 ** 16
+
 def align_blanks(s1, s2, return_ties=False):
     '''
     Add blanks ('EMPTY_STRING'), so that s1 and s2 are optimaly aligned and of the same length.
     Assumes that len(s1) < len(s2).
+
+    Alignments are computed by dynamic programming (see optimal_alignments) and cached on (s1, s2).
+    '''
+    if EMPTY_STRING in s1: # the blank-index tie-breaker would be ambiguous, so fall back to the exhaustive search
+        return align_blanks_search(s1, s2, return_ties=return_ties)
+    ties = optimal_alignments(s1, s2)
+    if return_ties and len(s1) > 0 and len(s2) > len(s1): # i.e., there is more than one way to add the blanks
+        return list(ties)
+    return ties[0]
+
+@lru_cache(maxsize=ALIGNMENT_CACHE_SIZE)
+def optimal_alignments(s1, s2):
+    '''
+    :return: a tuple of every way of adding blanks to s1 that minimizes its Hamming distance to s2, ordered by the positions of the blanks (earlier first), as align_blanks_search ranks them
+    '''
+    n1, n2 = len(s1), len(s2)
+    if n2 < n1:
+        raise ValueError(f'Cannot align "{s1}" to the shorter "{s2}".')
+    # cost[i][j] is the fewest mismatches with which s1[j:] (plus blanks) can be aligned to s2[i:]
+    cost = [[None] * (n1 + 1) for _ in range(n2 + 1)]
+    cost[n2][n1] = 0
+    for i in reversed(range(n2)):
+        for j in range(n1 + 1):
+            blanks = (n2 - i) - (n1 - j)
+            if blanks < 0:
+                continue
+            options = list()
+            if blanks > 0:
+                options.append((s2[i] != EMPTY_STRING) + cost[i + 1][j])
+            if j < n1:
+                options.append((s1[j] != s2[i]) + cost[i + 1][j + 1])
+            cost[i][j] = min(options)
+
+    def expand(i, j):
+        if i == n2:
+            yield ''
+            return
+        if (n2 - i) - (n1 - j) > 0 and (s2[i] != EMPTY_STRING) + cost[i + 1][j] == cost[i][j]: # a blank here comes first
+            for rest in expand(i + 1, j):
+                yield EMPTY_STRING + rest
+        if j < n1 and (s1[j] != s2[i]) + cost[i + 1][j + 1] == cost[i][j]:
+            for rest in expand(i + 1, j + 1):
+                yield s1[j] + rest
+
+    return tuple(expand(0, 0))
+
+def align_blanks_search(s1, s2, return_ties=False):
+    '''
+    Same as align_blanks, but by scoring every placement of the blanks.
     '''
     delta = len(s2) - len(s1)
     options = sorted(insert_empty(s1, k=delta), key=lambda op: (hd(op, s2), op.index(EMPTY_STRING)))
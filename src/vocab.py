@@ -0,0 +1,138 @@
+from collections import defaultdict
+from sequence import Sequence
+from utils import align_blanks
+
+def sf_alignments(uf, sf):
+    '''
+    :return: the ways of padding :sf: with blanks to align it with the longer :uf: (as a tuple of Sequences), which rules score deletions against
+    '''
+    sf = align_blanks(f'{sf}', f'{uf}', return_ties=True)
+    if type(sf) is str:
+        return (Sequence(sf),)
+    return tuple(Sequence(_sf) for _sf in sf)
+
+def frozen(seq):
+    '''
+    :return: :seq: as a FrozenSequence, or as a string if it is not a Sequence of the segments of an alphabet (e.g., it is
+             already a string); either way, its hash is computed once, rather than from its segments on every lookup
+    '''
+    if type(seq) is Sequence and seq.alphabet is not None:
+        try:
+            return seq.freeze()
+        except ValueError: # e.g., a segment of another alphabet
+            pass
+    return f'{seq}'
+
+class AlignedPair(tuple):
+    '''
+    A (UR, SR) pair that also stores its alignment, so that it is computed once rather than on every rule evaluation,
+    and its weight (e.g., token frequency) in the n and c of rules (see Rule.get_n_c).
+    Since it is a tuple, it can be used anywhere a (uf, sf) pair can. It hashes as its :key: (see Vocab.key), which is
+    equal to the pair but cheap to hash, so that sets and dicts of pairs (such as RuleBuilder.pairs) do not hash the Sequences.
+    '''
+    def __new__(cls, uf, sf, aligned_uf=None, aligned_sf=None, weight=1, key=None):
+        pair = super().__new__(cls, (uf, sf))
+        pair.aligned_uf = aligned_uf
+        pair.aligned_sf = aligned_sf
+        pair.weight = weight
+        pair.key = key if key is not None else Vocab.key(uf, sf)
+        pair._sf_alignments = None
+        return pair
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __getnewargs__(self): # for pickling, since __new__ takes the pair's parts rather than a tuple
+        return (self.uf, self.sf, self.aligned_uf, self.aligned_sf, self.weight, self.key)
+
+    @property
+    def uf(self):
+        return self[0]
+
+    @property
+    def sf(self):
+        return self[1]
+
+    def sf_alignments(self):
+        '''
+        :return: the (cached) alignments of the SR to the UR, including ties; see sf_alignments
+        '''
+        if self._sf_alignments is None:
+            self._sf_alignments = sf_alignments(self.uf, self.sf)
+        return self._sf_alignments
+
+class Vocab:
+    '''
+    The store of (UR, SR) pairs seen in training, each kept as an AlignedPair, keyed by its key (see Vocab.key).
+    '''
+    def __init__(self):
+        self.pairs = dict()
+        self.weight = 0 # the total weight of the pairs
+
+    @staticmethod
+    def key(uf, sf):
+        '''
+        :return: the key of the (:uf:, :sf:) pair: the pair with its parts frozen (see frozen), which hashes and compares
+                 equal to the pair
+        '''
+        return (frozen(uf), frozen(sf))
+
+    def add(self, uf, sf, aligned_uf=None, aligned_sf=None, freq=None, key=None):
+        '''
+        Adds the (:uf:, :sf:) pair, if it is not already in the vocab.
+
+        :freq: if given, added to the pair's weight; otherwise, the pair has weight 1 (so repeated pairs count once)
+        :key: (optional) the pair's key, if already computed
+        :return: the pair's AlignedPair
+        '''
+        key = key if key is not None else Vocab.key(uf, sf)
+        if key not in self.pairs:
+            self.pairs[key] = AlignedPair(uf, sf, aligned_uf, aligned_sf, weight=freq if freq is not None else 1, key=key)
+            self.weight += self.pairs[key].weight
+        elif freq is not None:
+            self.pairs[key].weight += freq
+            self.weight += freq
+        return self.pairs[key]
+
+    def __getitem__(self, pair):
+        return self.pairs[pair.key if type(pair) is AlignedPair else Vocab.key(*pair)]
+
+    def __contains__(self, pair):
+        return (pair.key if type(pair) is AlignedPair else Vocab.key(*pair)) in self.pairs
+
+    def __iter__(self):
+        return iter(self.pairs.values())
+
+    def __len__(self):
+        return len(self.pairs)
+
+class NGrams:
+    '''
+    Counts of the (character) n-grams of the URs seen in training, for each length in :lens:.
+    The n-grams are packed as strings, rather than as Sequences, so they are cheap to store, hash and compare;
+    sequence() turns one into the Sequence that rules apply to.
+    '''
+    def __init__(self, lens, alphabet):
+        self.alphabet = alphabet
+        self.counts = dict((k, defaultdict(int)) for k in lens)
+
+    def add(self, uf, freq=1):
+        '''
+        Counts the n-grams of :uf: followed by a word boundary, :freq: times.
+        '''
+        s = f'{uf}#'
+        for k, counts in self.counts.items():
+            for i in range(len(s) - k + 1):
+                counts[s[i:i + k]] += freq
+
+    def sequence(self, ngram):
+        return Sequence(list(ngram), self.alphabet)
+
+    def __getitem__(self, k):
+        '''
+        :return: the dict from the (packed) n-grams of length :k: to their frequencies
+        '''
+        return self.counts[k]
+
+    def __contains__(self, k):
+        return k in self.counts
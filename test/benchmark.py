@@ -0,0 +1,141 @@
+import sys
+sys.path.append('../src/')
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from plp import PLP
+from utils import load
+
+'''
+A script to benchmark training and inference on the German, English and Polish corpora, at several training set sizes.
+Each run is in a fresh, spawned (rather than forked) process, so that its peak memory is its own, and the results are written as JSON.
+peak_rss_kb is the peak resident memory of that process (ru_maxrss), which includes the interpreter and the imported modules;
+start_rss_kb is its resident memory before the run loads the corpus.
+
+Run from this directory, e.g.:
+    python benchmark.py --corpora ger eng --sizes 500 1000 --out results.json
+    python benchmark.py --compare old.json results.json
+'''
+
+CORPORA = {
+    'ger': ('../data/german/ger.txt', dict(ipa_file='../data/german/ipa.txt')),
+    'eng': ('../data/english/eng.txt', dict(nas_vowels=True)),
+    'pol': ('../data/polish/pol.txt', dict(ipa_file='../data/polish/ipa.txt')),
+}
+
+UPDATE_STAGES = ('merge_rules', 'order_rules_by_scope', 'induce_natural_classes', 'order_rules')
+
+def new_model(corpus):
+    '''
+    :return: a profiled PLP for :corpus: (see Profiler)
+    '''
+    return PLP(verbose=False, cache_size=0, profile=True, **CORPORA[corpus][1]) # no output cache, so produce times the grammar
+
+def stage_times(plp):
+    '''
+    :return: the total time of update_rules and of each of its stages, and the counters of the work done in training
+    '''
+    stats = plp.profiler.stats()
+    times = dict((stage, stats['stages'][stage]['seconds'] if stage in stats['stages'] else 0) for stage in ('update_rules',) + UPDATE_STAGES)
+    return times, stats['counters']
+
+def run(corpus, size, incremental, test_size):
+    '''
+    Benchmarks training on the first :size: pairs of :corpus: (in batch, and the first :incremental: incrementally) and
+    producing the next :test_size: (or the training pairs, if there are no more).
+
+    :return: a dict of the results
+    '''
+    start_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pairs, _ = load(CORPORA[corpus][0], skip_header=True)
+    train, test = pairs[:size], pairs[size:size + test_size]
+    if len(test) == 0: # e.g., the Polish corpus is small enough to train on all of it
+        test = train[:test_size]
+    result = {'corpus': corpus, 'size': len(train), 'test_size': len(test), 'test_on_train': len(pairs) <= size}
+
+    plp = new_model(corpus)
+    start = time.perf_counter()
+    plp.train(train)
+    result['train'] = time.perf_counter() - start
+    result['train_stages'], result['train_counters'] = stage_times(plp)
+    result['rules'] = len(plp.grammar)
+
+    start = time.perf_counter()
+    for uf, _ in test:
+        plp.produce(uf)
+    result['produce'] = time.perf_counter() - start
+    start = time.perf_counter()
+    result['accuracy'] = plp.accuracy(test)
+    result['accuracy_time'] = time.perf_counter() - start
+
+    plp = new_model(corpus)
+    start = time.perf_counter()
+    for pair in train[:incremental]:
+        plp.train_incremental(pair)
+    result['incremental_size'] = min(incremental, len(train))
+    result['train_incremental'] = time.perf_counter() - start
+    result['train_incremental_stages'], result['train_incremental_counters'] = stage_times(plp)
+
+    result['start_rss_kb'] = start_rss_kb
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # the process runs nothing else
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_file, new_file):
+    '''
+    Prints the ratio (new / old) of each time and the peak memory of the runs in both :old_file: and :new_file:.
+    '''
+    with open(old_file, 'r') as f:
+        old = dict(((r['corpus'], r['size']), r) for r in json.load(f)['results'])
+    with open(new_file, 'r') as f:
+        new = dict(((r['corpus'], r['size']), r) for r in json.load(f)['results'])
+    keys = ('train', 'train_incremental', 'produce', 'accuracy_time', 'peak_rss_kb')
+    print('corpus\tsize\t' + '\t'.join(keys))
+    for run_key in sorted(set(old).intersection(new)):
+        ratios = (f'{new[run_key][key] / old[run_key][key]:.2f}' if old[run_key][key] else '-' for key in keys)
+        print(f'{run_key[0]}\t{run_key[1]}\t' + '\t'.join(ratios))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PLP training and inference.')
+    parser.add_argument('--corpora', nargs='+', choices=sorted(CORPORA), default=sorted(CORPORA))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[250, 500, 1000, 2000], help='training set sizes (capped at the corpus size)')
+    parser.add_argument('--incremental', type=int, default=500, help='the number of pairs to train incrementally on, per run')
+    parser.add_argument('--test-size', type=int, default=2000, help='the number of held-out pairs to produce')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of benchmarking')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    results = list()
+    for corpus in args.corpora:
+        num_pairs = len(load(CORPORA[corpus][0], skip_header=True)[0])
+        for size in sorted(set(min(size, num_pairs) for size in args.sizes)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool: # a fresh process per run, which does not inherit this one's memory
+                result = pool.submit(run, corpus, size, args.incremental, args.test_size).result()
+            print(f"{corpus}\t{result['size']}\ttrain {result['train']:.2f}s\tincremental {result['train_incremental']:.2f}s\t"
+                  f"produce {result['produce']:.2f}s\taccuracy {result['accuracy']:.3f}\tpeak {result['peak_rss_kb'] / 1024:.0f} MiB")
+            results.append(result)
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'results': results,
+        }, f, indent=2)
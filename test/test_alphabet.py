@@ -4,6 +4,7 @@ from collections import defaultdict
 sys.path.append('../src/')
 from utils import load
 from alphabet import Alphabet
+from natural_class import NaturalClass
 
 class TestAlphabet(unittest.TestCase):
     def test_getitem_1(self):
@@ -65,5 +66,60 @@ class TestAlphabet(unittest.TestCase):
             assert(vec not in vecs)
             vecs[vec] = seg
 
+    def test_seg_ids_and_masks(self):
+        alphabet = Alphabet(add_segs=True, nas_vowels=True)
+
+        ids = set()
+        for seg in alphabet:
+            seg_id = alphabet.seg_id(seg)
+            assert(seg_id not in ids)
+            ids.add(seg_id)
+            assert(alphabet.id_to_seg[seg_id] == seg)
+            assert(alphabet.masks(seg) == alphabet.vec_to_masks(seg.feature_vec))
+
+        plus, minus = alphabet.masks('b')
+        voi = alphabet.feat_bit('voi')
+        assert(plus & voi and not minus & voi)
+        assert(alphabet.masks_to_segment[(plus & ~voi, minus | voi)] == 'p')
+        assert(alphabet.get_val('b', 'voi') == '+')
+        assert(alphabet.set_feats('b', ['voi'], ['-']) == 'p')
+
+    def test_shared_feature_table(self):
+        alphabet = Alphabet(add_segs=True, nas_vowels=True)
+        other = Alphabet(segs=['b'])
+        assert(alphabet.seg_to_feats.maps[-1] is other.seg_to_feats.maps[-1]) # the IPA file is parsed once
+        assert(len(other.segments) < len(alphabet.segments))
+        assert('b\u0303' not in other.seg_to_feats.maps[-1])
+        assert(other['b'].feature_vec == alphabet['b'].feature_vec)
+        assert(Alphabet(ipa_file='../data/german/ipa.txt').seg_to_feats.maps[-1] is not other.seg_to_feats.maps[-1])
+
+    def test_feature_tables(self):
+        alphabet = Alphabet(add_segs=True, nas_vowels=True)
+        for feat in ['+voi', '-son', '?back', '+nas']:
+            segs = set(seg for seg in alphabet if feat in alphabet.feat_vals(seg))
+            assert(len(segs) > 0)
+            assert(set(alphabet.id_to_seg[i] for i in range(len(alphabet.id_to_seg)) if alphabet.feat_val_bits[feat] >> i & 1) == segs)
+        for feats in [{'+voi', '-son'}, {'-cons'}, set(), {'+voi', '-voi'}]:
+            assert(alphabet.extension(set(feats)) == set(seg for seg in alphabet if feats.issubset(alphabet.feat_vals(seg))))
+        assert(alphabet.extension({'+nonfeat'}) == set())
+        assert(alphabet.shared_feats(['b', 'd']) == alphabet.feat_vals('b', exclude_unspec=True).intersection(alphabet.feat_vals('d', exclude_unspec=True)))
+        assert(all(feat[0] != '?' for feat in alphabet.shared_feats(['a'])))
+        assert('?back' in alphabet.shared_feats(['b', 'd'], exclude_unsepc=False) or '?back' not in alphabet.feat_vals('b'))
+
+    def test_extension_1(self):
+        alphabet = Alphabet(add_segs=True)
+
+        nat_class = NaturalClass({'-son'}, alphabet)
+        ext = alphabet.extension(nat_class)
+        assert('b' in ext and 'p' in ext)
+        nat_class.add_feat('+voi')
+        ext = alphabet.extension(nat_class)
+        assert('b' in ext and 'p' not in ext)
+        assert(ext == set(seg for seg in alphabet if seg in nat_class))
+        assert(alphabet.extension_complement(nat_class) == alphabet.complement(ext))
+        nat_class.remove_feat('+voi')
+        assert('p' in alphabet.extension(nat_class))
+        assert(len(alphabet.extension({'+voiced'})) == 0)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,10 +1,16 @@
 import unittest
 import sys
 sys.path.append('../src/')
-from utils import load
+from utils import load, stream
 from plp import PLP
+from nat_class_gen import NatClassGen
+from sequence import Sequence, FrozenSequence
 import numpy as np
 import random
+import tempfile
+import os
+import pickle
+import subprocess
 
 class TestPLP(unittest.TestCase):
     def assert_correct(self, plp, pairs):
@@ -238,5 +244,359 @@ class TestPLP(unittest.TestCase):
         plp.train(pairs)
         assert(plp.discrepancies[('z', 's')] == 'z --> s / {f,p,t} __ ')
 
+    def test_vectorized_nat_classes(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False)
+        plp.train(pairs[:200])
+
+        for r in plp.discrepancies.get_rules():
+            r = r.copy().feature_changeify()
+            ngrams = list((plp.n_grams.sequence(ngram), f) for ngram, f in plp.n_grams[len(r)].items())
+            r_vec = NatClassGen(plp.alphabet, False, vectorized=True).induce_nat_classes(r, ngrams)
+            r_loop = NatClassGen(plp.alphabet, False, vectorized=False).induce_nat_classes(r, ngrams)
+            assert(r_vec == r_loop)
+
+    def test_context_index(self):
+        pairs = [('dɑgz', 'dɑgz'), ('seɪfz', 'seɪfs'), ('mæpz', 'mæps'), ('hɔrsz', 'hɔrsəz'), ('kætz', 'kæts'), ('bɝdz', 'bɝdz'), ('wɛbz', 'wɛbz'), ('ðs', 's')]
+        plp = PLP(nas_vowels=True, verbose=False)
+        for pair in pairs:
+            plp.add_incremental(pair)
+
+        a = plp.alphabet
+        for target, b, windows in [('z', 's', [[{a['f'], a['p'], a['t']}, {'_'}], [{'_'}, {'#'}], [{a['t']}, {'_'}, {'#'}], [{'#'}, {a['d']}, {'_'}]]),
+                                   ('ð', 'λ', [[{'_'}, {a['s']}], [{'#'}, {'_'}]]),
+                                   ('λ', 'ə', [[{a['s']}, {'_'}], [{'_'}, {a['z']}], [{a['s']}, {'_'}, {a['z']}]])]:
+            rb = plp.rule_builders[target]
+            assert(rb.context_index.valid)
+            for window in windows + [[{'_'}, set(it.rc[0] for it in rb.instances)]]: # the last matches every occurrence
+                assert(rb.get_n_c(window, b) == rb.build_rule_from_window(window, b).get_n_c(rb.pairs))
+
+    def test_incremental_counts(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False)
+        for pair in pairs[:150] + pairs[:10]: # repeated pairs should not be recounted
+            plp.train_incremental(pair)
+
+        for (seg, b), rule in plp.discrepancies.items():
+            if (seg, b) in plp.counts:
+                assert(plp.counts[(seg, b)] == plp.n_c(rule, plp.rule_builders[seg].pairs))
+        if plp.grammar_counts is not None:
+            assert(plp.grammar_counts == [plp.n_c(r, plp.vocab) for r in plp.grammar.rules])
+        self.assert_correct(plp, pairs[:150])
+
+    def test_parallel_train(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        pairs = pairs[:300]
+        serial = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs)
+        parallel = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs, workers=2)
+
+        assert(list(parallel.discrepancies.keys()) == list(serial.discrepancies.keys()))
+        assert(f'{parallel.discrepancies}' == f'{serial.discrepancies}')
+        assert(f'{parallel}' == f'{serial}')
+        for rule in parallel.discrepancies.get_rules(): # the built rules should share the model's alphabet
+            assert(rule.alphabet is parallel.alphabet)
+        self.assert_correct(parallel, pairs)
+
+    def test_produce_batch(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:200])
+        test = pairs[200:400] + pairs[200:250] # repeated URs in a chunk
+        urs = list(uf for uf, _ in test)
+        preds = list(plp.produce(uf) for uf in urs)
+
+        assert(list(plp.produce_batch(urs, chunksize=64)) == preds)
+        assert(list(plp.produce_batch(iter(urs), workers=2, chunksize=64)) == preds)
+        assert(plp.accuracy(test, workers=2, chunksize=64) == plp.accuracy(test))
+
+        # the rule outputs θ, which first appears in a chunk that the other worker may produce
+        pairs = [('diə.', 'diə.'), ('und.', 'unt.'), ('bad.', 'bat.'), ('badə.', 'badə.'), ('lib.', 'lip.'), ('libə.', 'libə.')]
+        urs = ['ta.'] * 3 + ['θa.'] + ['uð.'] * 20
+        preds = list(PLP(verbose=False).train(pairs).produce_batch(urs, chunksize=1))
+        assert(preds[-1] == 'uθ.')
+        assert(list(PLP(verbose=False).train(pairs).produce_batch(urs, workers=2, chunksize=1)) == preds)
+
+    def test_application_index(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False).train(pairs[:400])
+        index = plp.grammar.application_index
+        rules = plp.grammar.rules
+        assert(len(rules) > 1)
+        for ri in rules:
+            for rj in rules:
+                if ri is not rj:
+                    assert(index.more_specific(ri, rj) == ri.more_specific(rj, plp.vocab))
+
+        # unchanged rules keep their entries, extended over the new pairs
+        entries = dict((key, entry[0]) for key, entry in index.entries.items())
+        for pair in pairs[400:500]:
+            plp.train_incremental(pair)
+        plp.grammar.order_rules(plp.vocab)
+        assert(len(set(entries).intersection(index.entries)) > 0)
+        for key, outputs in entries.items():
+            if key in index.entries:
+                assert(index.entries[key][0] is outputs)
+                assert(len(outputs) == len(plp.vocab))
+
+    def test_applier(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False).train(pairs[:400])
+        rules = plp.grammar.rules
+        assert(len(rules) > 1)
+        def apply(uf): # every rule at every window
+            sf = uf
+            for rule in rules:
+                sf = rule.apply(sf)
+            return sf
+        for uf, _ in pairs[:1000]:
+            assert(f'{plp.produce(uf)}' == f'{apply(Sequence(uf, plp.alphabet))}')
+        applier = plp.grammar.applier
+        assert(applier.rules == rules)
+        assert(applier.candidates(Sequence('tata', plp.alphabet).seq) != (1 << len(rules)) - 1) # some rules cannot fire
+
+    def test_output_cache(self):
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False)
+        plp.train_incremental(('hʊnd.', 'hʊnt.'))
+        plp.train_incremental(('tsug.', 'tsuk.'))
+        assert(plp.produce('dɔf.') == 'tɔf.' and len(plp.output_cache) == 1)
+        plp.train_incremental(('ganz.', 'gans.')) # the grammar changes, so the cache is cleared
+        assert(plp.produce('dɔf.') == 'dɔf.')
+
+        for uf in ['bʊnd.', 'ʃtɔf.']: # new segments clear the cache, as they can change the SRs
+            plp.produce(uf)
+        plp.output_cache = PLP.OutputCache(2)
+        for uf in ['bʊnd.', 'ʃtɔf.', 'bʊnd.', 'dɔf.', 'bʊnd.']:
+            plp.produce(uf)
+        assert(plp.output_cache.stats() == {'hits': 2, 'misses': 3, 'entries': 2})
+        assert(list(plp.output_cache.entries) == ['dɔf.', 'bʊnd.']) # 'ʃtɔf.' was least recently used
+        assert(plp.produce('bʊnd.') is plp.produce('bʊnd.') and plp.produce('bʊnd.') == 'bʊnt.')
+
+    def test_profiler(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:100])
+        assert(len(plp.profiler.stages) == 0 and len(plp.profiler.counters) == 0) # disabled by default
+
+        ended = list()
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False, profile=True)
+        plp.profiler.callback = lambda stage, seconds: ended.append(stage)
+        plp.train(pairs[:100])
+        plp.train_incremental(pairs[100])
+        stats = plp.profiler.stats()
+        for stage in ['train', 'train_incremental', 'update_rules', 'merge_rules', 'order_rules_by_scope', 'induce_natural_classes', 'order_rules']:
+            assert(stats['stages'][stage]['calls'] >= 1)
+        assert(stats['stages']['train']['calls'] == 1 and stats['stages']['update_rules']['seconds'] <= stats['stages']['train']['seconds'] + stats['stages']['train_incremental']['seconds'])
+        assert(ended.index('update_rules') < ended.index('train')) # stages end innermost first
+        assert(stats['counters']['get_n_c'] > 0 and stats['counters']['get_n_c_pairs'] >= stats['counters']['get_n_c'])
+        assert(stats['counters']['context_index_n_c'] > 0) # rules being built are scored through the context index
+
+        # exactly the pairs scanned (even from a generator) and the occurrences intersected are counted
+        (seg, b), rule = next((seg_b, r) for seg_b, r in plp.discrepancies.items() if plp.rule_builders[seg_b[0]].context_index.valid)
+        rb = plp.rule_builders[seg]
+        plp.profiler.reset()
+        with plp.profiler.stage('count'):
+            rule.get_n_c(pair for pair in rb.pairs)
+            rule.get_n_c(list(rb.pairs)[:3])
+            rb.get_n_c([{'_'}, {'#'}], b)
+        assert(plp.profiler.stats()['counters'] == {'get_n_c': 2, 'get_n_c_pairs': len(rb.pairs) + min(3, len(rb.pairs)),
+                                                     'context_index_n_c': 1, 'context_index_occs': rb.context_index.num_occs})
+        plp.profiler.reset()
+        plp.produce('hʊnd.') # outside of any stage
+        assert(len(plp.profiler.stats()['counters']) == 0)
+
+    def test_merge_rules(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False).train(pairs[:320])
+        rules = list(r.copy().feature_changeify() for r in plp.discrepancies.get_rules())
+
+        # merge by restarting the scan after every change
+        plp.grammar.set_rules(list(r.copy() for r in rules))
+        change = True
+        while change:
+            change = False
+            pool = sorted(plp.grammar.rules)
+            for i in range(len(pool)):
+                for j in range(i + 1, len(pool)):
+                    if pool[i] in plp.grammar and pool[j] in plp.grammar and pool[i].merge(pool[j], plp.vocab):
+                        plp.grammar.remove(pool[j])
+                        change = True
+        expected = f'{plp.grammar}'
+
+        plp.grammar.set_rules(list(r.copy() for r in rules))
+        plp.merge_rules()
+        assert(len(plp.grammar) < len(rules))
+        assert(f'{plp.grammar}' == expected)
+
+    def test_ngram_rewrites(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False).train(pairs[:1000])
+        assert(len(plp.grammar) > 1)
+        for rank in range(len(plp.grammar) + 1):
+            for k in plp.n_gram_lens:
+                rewrites = plp.rewrite_ngrams(k, rank)
+                for ngram in plp.n_grams[k]:
+                    rewrite = plp.n_grams.sequence(ngram)
+                    for r in plp.grammar[:rank]:
+                        rewrite = r.apply(rewrite)
+                    assert(rewrites[ngram] == rewrite if ngram in rewrites else rewrite == ngram and len(rewrite) == k)
+
+        # unchanged prefixes are reused
+        stages = dict((k, dict(plp.ngram_rewrites[k])) for k in plp.n_gram_lens)
+        plp.update_rules()
+        for k in plp.n_gram_lens:
+            for prefix, rewrites in plp.ngram_rewrites[k].items():
+                if prefix in stages[k]:
+                    assert(rewrites is stages[k][prefix])
+
+    def test_ngram_store(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False)
+        for pair in pairs[:300]:
+            plp.add_incremental(pair)
+
+        for k in plp.n_gram_lens:
+            counts = dict()
+            for uf, _ in pairs[:300]:
+                s = f'{uf}#'
+                for i in range(len(s) - k + 1):
+                    ngram = Sequence(list(s[i:i + k]), plp.alphabet)
+                    counts[ngram] = counts.get(ngram, 0) + 1
+            assert(dict((plp.n_grams.sequence(ngram), f) for ngram, f in plp.n_grams[k].items()) == counts)
+
+    def test_vocab_keys(self):
+        pairs, _ = load('../data/english/eng.txt', skip_header=True)
+        plp = PLP(nas_vowels=True, verbose=False)
+        for pair in pairs[:100]:
+            plp.add_incremental(pair)
+
+        for key, pair in plp.vocab.pairs.items():
+            assert(key is pair.key and all(type(part) is FrozenSequence for part in key))
+            assert(key == pair and hash(key) == hash(pair) == hash((f'{pair.uf}', f'{pair.sf}')))
+        uf, sf = pairs[0]
+        pair = plp.vocab[(Sequence(uf, plp.alphabet), Sequence(sf, plp.alphabet))]
+        assert(pair is plp.vocab[(uf, sf)] and (uf, sf) in plp.vocab and (uf, uf + uf) not in plp.vocab)
+        for rb in plp.rule_builders.values(): # the builders' pairs are the vocab's
+            assert(all(plp.vocab[pair] is pair for pair in rb.pairs))
+
+    def test_weighted_train(self):
+        pairs, freqs = load('../data/german/ger.txt', skip_header=True)
+        pairs, freqs = pairs[:150], list(int(f) % 4 + 1 for f in freqs[:150])
+        weighted = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs, freqs=freqs)
+        tokens = PLP(ipa_file='../data/german/ipa.txt', verbose=False)
+        for pair, f in zip(pairs, freqs):
+            for _ in range(f):
+                tokens.add_incremental(pair)
+
+        # n-grams are as if each pair occurred :freq: times
+        for k in weighted.n_gram_lens:
+            assert(dict(weighted.n_grams[k]) == dict(tokens.n_grams[k]))
+        assert(weighted.vocab.weight == sum(freqs))
+
+        # the n and c of rules are weighted, including those computed from the context index
+        windows = [[{'_'}, {'.'}], [{'#'}, {'_'}], [{'_'}, {'.'}, {'#'}]]
+        for (seg, b), rule in weighted.discrepancies.items():
+            rb = weighted.rule_builders[seg]
+            n, c = 0, 0
+            for pair in rb.pairs:
+                _n, _c = rule.get_n_c([(pair.uf, pair.sf)])
+                n += pair.weight * _n
+                c += pair.weight * _c
+            assert(weighted.n_c(rule, rb.pairs) == (n, c))
+            weighted.add_incremental(next(iter(rb.pairs)), freq=10) # reweight a pair
+            assert(rb.context_index.valid)
+            for window in windows + [[{'_'}, set(it.rc[0] for it in rb.instances)]]: # the last matches every occurrence
+                assert(rb.get_n_c(window, b) == rb.build_rule_from_window(window, b).get_n_c(rb.pairs))
+
+    def test_weighted_train_without_freqs(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        pairs = pairs[:150] + pairs[:20] # with repeated pairs
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'pairs.txt')
+            with open(fname, 'w') as f:
+                f.write('UF\tSF\n' + ''.join(f'{uf}\t{sf}\n' for uf, sf in pairs))
+            _, freqs = load(fname, skip_header=True)
+            assert(all(freq is None for freq in freqs))
+            for weighted in [PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(stream(fname, skip_header=True), weighted=True),
+                             PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs, freqs=freqs)]:
+                assert(f'{weighted}' == f'{plp}') # without frequencies, pairs are not weighted
+                assert(weighted.vocab.weight == len(weighted.vocab) == len(set(pairs)))
+                assert(dict(weighted.n_grams[2]) == dict(plp.n_grams[2]))
+        self.assertRaises(ValueError, plp.add_incremental, pairs[0], freq=0)
+
+    def test_train_batches(self):
+        pairs, freqs = load('../data/german/ger.txt', skip_header=True)
+        batches = list(list((uf, sf, f) for (uf, sf), f in zip(pairs[i:i + 64], freqs[i:i + 64])) for i in range(0, 320, 64))
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:320])
+        batched = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(iter(batches))
+        assert(f'{batched}' == f'{plp}')
+        assert(len(batched.vocab) == len(plp.vocab) and batched.vocab.weight == plp.vocab.weight)
+
+        weighted = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:320], freqs=freqs[:320])
+        batched = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(iter(batches), weighted=True)
+        assert(f'{batched}' == f'{weighted}')
+        assert(batched.vocab.weight == weighted.vocab.weight == sum(freqs[:320]))
+
+        assert(plp.accuracy(iter(batches)) == plp.accuracy(pairs[:320]))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'test.txt')
+            with open(fname, 'w') as f:
+                for uf, sf in pairs[320:640]:
+                    f.write(f'{uf}\t{sf}\n')
+            assert(plp.accuracy(fname) == plp.accuracy(stream(fname, chunksize=50)) == plp.accuracy(pairs[320:640]))
+
+    def test_save_load(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:300])
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'model.plp')
+            plp.save(fname, training_state=False)
+            loaded = PLP.load(fname)
+            assert(f'{loaded}' == f'{plp}')
+            assert(list(loaded.produce_batch(uf for uf, _ in pairs[300:600])) == list(plp.produce_batch(uf for uf, _ in pairs[300:600])))
+
+            plp.save(fname)
+            loaded = PLP.load(fname)
+            for pair in pairs[300:350]: # training continues as if the model had not been saved
+                plp.train_incremental(pair)
+                loaded.train_incremental(pair)
+            assert(f'{loaded}' == f'{plp}')
+            assert(len(loaded.vocab) == len(plp.vocab))
+
+            with open(fname, 'wb') as f:
+                f.write(b'not a model')
+            self.assertRaises(pickle.UnpicklingError, PLP.load, fname)
+            with open(fname, 'wb') as f:
+                pickle.dump({'a': 1}, f) # a pickle, but not of a model
+            self.assertRaisesRegex(ValueError, 'is not a saved PLP model', PLP.load, fname)
+            with open(fname, 'wb') as f:
+                pickle.dump(('plp-model', 999, False, dict()), f) # an unsupported version
+            self.assertRaisesRegex(ValueError, 'version 999', PLP.load, fname)
+
+    def test_save_load_across_processes(self):
+        pairs, _ = load('../data/german/ger.txt', skip_header=True)
+        plp = PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:300])
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'model.plp')
+            script = (
+                "import sys; sys.path.append('../src/')\n"
+                "from plp import PLP\n"
+                "from utils import load\n"
+                "pairs, _ = load('../data/german/ger.txt', skip_header=True)\n"
+                "if sys.argv[1] == 'save':\n"
+                "    PLP(ipa_file='../data/german/ipa.txt', verbose=False).train(pairs[:300]).save(sys.argv[2])\n"
+                "else:\n"
+                "    plp = PLP.load(sys.argv[2])\n"
+                "    assert(hash(plp.alphabet['s']) == hash('s') and 's' in plp.alphabet.segments)\n"
+                "    for pair in pairs[300:350]:\n"
+                "        plp.train_incremental(pair)\n"
+                "    print(plp)\n"
+            )
+            # string hashes differ between processes with different seeds (as between runs, or spawned workers)
+            subprocess.run([sys.executable, '-c', script, 'save', fname], env=dict(os.environ, PYTHONHASHSEED='1'), check=True)
+            loaded = subprocess.run([sys.executable, '-c', script, 'load', fname], env=dict(os.environ, PYTHONHASHSEED='2'),
+                                    check=True, capture_output=True, text=True).stdout
+            for pair in pairs[300:350]:
+                plp.train_incremental(pair)
+            assert(loaded == f'{plp}\n')
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -8,6 +8,7 @@ from sequence import Sequence
 from alphabet import Alphabet
 from rule import Rule
 from natural_class import NaturalClass
+from vocab import Vocab
 
 class TestRule(unittest.TestCase):
     def to_seq(self, pair, alphabet):
@@ -416,6 +417,36 @@ class TestRule(unittest.TestCase):
         assert(r.update_at(3, 'n'))
         assert(r == ' --> b / xyz __ njk')
 
+    def test_compiled_apply_1(self):
+        alphabet = Alphabet(add_segs=True, nas_vowels=True)
+        rules = [Rule(A='d', B='t', D='#'), Rule(A='', B='ɪ', C='t'), Rule(A='a', B='b', C='#a'),
+                 Rule(A='i', B='+nas', D=[{'n', 'm'}], alphabet=alphabet),
+                 Rule(A='d', B='-voi', C=[NaturalClass({'-voi'}, alphabet=alphabet)], alphabet=alphabet)]
+        for r in rules:
+            for s in ['und', 'wɔntd', 'aab', 'pin', 'pim', 'td', 'ad']:
+                for uf in [s, Sequence(s, alphabet=alphabet)]:
+                    assert(r.apply(uf) == r._apply_windowed(uf))
+                    n, c = r._matches_windowed(uf, uf)
+                    assert(r.applies(uf, uf) == (len(n), len(c)))
+
+    def test_compiled_invalidated_1(self):
+        r = Rule(A='z', B='s', C='k', D='#')
+        assert(r.apply('akz') == 'aks')
+        assert(r.apply('apz') == 'apz')
+        r.merge(Rule(A='z', B='s', C='p', D='#'), [])
+        assert(r.apply('apz') == 'aps')
+
+    def test_get_n_c_aligned_pairs(self):
+        pairs = [('θθ', 'θ'), ('ðθθ', 'θ'), ('θs', 's'), ('sθ', 'sθ')]
+        vocab = Vocab()
+        for uf, sf in pairs:
+            vocab.add(Sequence(uf), Sequence(sf))
+        vocab.add(Sequence('θθ'), Sequence('θ'))
+        assert(len(vocab) == 4)
+        assert(vocab[(Sequence('ðθθ'), Sequence('θ'))].sf_alignments() == ('λλθ', 'λθλ'))
+        for r in [Rule(A='θ', B='', D='θ'), Rule(A='θ', B='', D='s'), Rule(A='ð', B='', D='θ')]:
+            assert(r.get_n_c(vocab) == r.get_n_c(pairs))
+
     def test_A_index(self):
         r = Rule(A='a', B='b', C=['x', 'y', 'z'], D=['i', 'j', 'k'])
         assert(r.A_index() == 3)
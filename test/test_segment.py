@@ -3,6 +3,7 @@ import sys
 sys.path.append('../src/')
 from segment import Segment
 from alphabet import Alphabet
+from sequence import Sequence
 
 class TestSegment(unittest.TestCase):
     def test_init(self):
@@ -47,8 +48,18 @@ class TestSegment(unittest.TestCase):
         assert(s2 in segs)
         assert(s3 not in segs)
 
+    def test_interned(self):
+        alph = Alphabet(add_segs=True, nas_vowels=True)
+        b = alph['b']
+        assert(alph['b'] is b and Sequence('bab', alph)[0] is b)
+        assert(alph.id_to_seg[b.seg_id] is b)
+        alph.add_nas_vowels()
+        assert(alph['a\u0303'] is Sequence('a\u0303', alph)[0])
+        self.assertRaises(AttributeError, setattr, b, 'stress', 'ˈ') # slotted
 
-
+        other = Alphabet(add_segs=True)
+        assert(other['b'] is not b and other['b'] == b) # equal across alphabets
+        assert(b in {'b'} and 'b' in {b} and b == Sequence('b', alph))
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -137,5 +137,27 @@ class TestSequence(unittest.TestCase):
         assert(len(s1) == 2)
         assert(s1 != s2)
 
+    def test_frozen_sequence(self):
+        alph = Alphabet(add_segs=True, nas_vowels=True)
+        seq = Sequence('#pu\u0303ta#', alphabet=alph)
+        frozen = seq.freeze()
+        assert(len(frozen) == len(seq) == 6)
+        assert(frozen == seq and seq == frozen and frozen == f'{seq}')
+        assert(hash(frozen) == hash(seq) == hash(f'{seq}'))
+        assert(frozen[2] is alph['u\u0303'] and frozen[0] == '#' and frozen[-1] == '#')
+
+        view = frozen[1:4]
+        assert(view.ids is frozen.ids and view == 'pu\u0303t' and list(view.view()) == list(frozen.ids[1:4]))
+        assert(view[1:] == 'u\u0303t' and frozen[::-1] == '#atu\u0303p#')
+        assert(view.thaw() == Sequence('pu\u0303t', alphabet=alph))
+
+        counts = {'pu\u0303t': 1} # a FrozenSequence can look up keys that are strings
+        assert(counts[view] == 1)
+        self.assertRaises(ValueError, Sequence([{'a', 'b'}], alph).freeze)
+
+    def test_slice_alphabet(self):
+        alph = Alphabet(add_segs=True)
+        assert(Sequence('pat', alphabet=alph)[1:].alphabet is alph)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
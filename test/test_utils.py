@@ -2,7 +2,7 @@ import unittest
 import sys
 from collections import defaultdict
 sys.path.append('../src/')
-from utils import powerset, most_freq, windows, insert_empty
+from utils import powerset, most_freq, windows, insert_empty, align_blanks, align_blanks_search, load, stream
 
 class TestUtils(unittest.TestCase):
     def test_powerset_1(self):
@@ -48,5 +48,21 @@ class TestUtils(unittest.TestCase):
         assert(insert_empty('abcd', k=0) == ['abcd'])
         assert(set(insert_empty('abcd', k=2)) == {'λλabcd', 'λaλbcd', 'λabλcd', 'λabcλd', 'λabcdλ', 'aλλbcd', 'aλbλcd', 'aλbcλd', 'aλbcdλ', 'abλλcd', 'abλcλd', 'abλcdλ', 'abcλλd', 'abcλdλ', 'abcdλλ'})
 
+    def test_align_blanks(self):
+        assert(align_blanks('θ', 'ðθθ') == 'λλθ')
+        assert(align_blanks('s', 'θs', return_ties=True) == ['λs'])
+        assert(align_blanks('θ', 'θθ', return_ties=True) == ['λθ', 'θλ'])
+        assert(align_blanks('', 'ab', return_ties=True) == 'λλ')
+        for s1, s2 in [('abc', 'abxc'), ('aa', 'aaaa'), ('ab', 'bbaa'), ('wɔnt', 'wɔntɪd'), ('θ', 'ðθθ')]:
+            assert(align_blanks(s1, s2) == align_blanks_search(s1, s2))
+            assert(align_blanks(s1, s2, return_ties=True) == align_blanks_search(s1, s2, return_ties=True))
+
+    def test_stream(self):
+        for fname in ['../data/german/ger.txt', '../data/polish/pol.txt']:
+            pairs, freqs = load(fname, skip_header=True)
+            batches = list(stream(fname, skip_header=True, chunksize=1000))
+            assert(all(len(batch) == 1000 for batch in batches[:-1]))
+            assert(list(triple for batch in batches for triple in batch) == list((uf, sf, freq) for (uf, sf), freq in zip(pairs, freqs)))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file